@@ -3,25 +3,60 @@
 Flask application for DocTags web interface
 """
 
-from flask import Flask, request, send_file, jsonify
+from flask import (Flask, Response, request, send_file, send_from_directory, jsonify,
+                   stream_with_context)
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import NotFound
 import subprocess
+import hashlib
 import os
+import platform
+import shlex
 import sys
 import time
 import threading
 import logging
+import traceback
+import zipfile
 from pathlib import Path
 import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import pdf2image
+from PIL import Image
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from backend.utils import (ensure_results_folder, count_pdf_pages,
+from backend.utils import (ensure_results_folder, count_pdf_pages, render_pdf_page,
                            run_command_with_timeout, format_duration)
-from backend.config import (HOST, PORT, MAX_CONTENT_LENGTH, ALLOWED_EXTENSIONS,
-                            PREVIEW_DPI, PROCESSING_TIMEOUT, CLEANUP_INTERVAL,
-                            CLEANUP_AGE_HOURS)
+from backend.config import (DEBUG, HOST, PORT, MAX_CONTENT_LENGTH, SERVER_THREADS, USE_X_SENDFILE,
+                            MAX_EVENT_STREAMS, ALLOWED_EXTENSIONS, RESULTS_DIR, PREVIEW_DPI, PROCESSING_TIMEOUT,
+                            CLEANUP_INTERVAL, CLEANUP_AGE_HOURS, BATCH_EVENT_HEARTBEAT,
+                            DEFAULT_DPI, TASK_RESULTS_MAX, TASK_RESULTS_TTL, STATIC_MAX_AGE,
+                            PREVIEW_MAX_AGE, PREVIEW_CACHE_MAX_BYTES, JPEG_QUALITY, TASK_WORKERS,
+                            TASK_OUTPUT_TAIL, PREVIEW_MAX_WIDTH)
 from backend.multipart_handler import default_handler
+from backend.page_treatment import analyzer, visualizer, picture_extractor
+
+# PyMuPDF renders previews in-process; pdf2image (poppler subprocess) is the fallback
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+# Production WSGI server; the Werkzeug development server is the fallback
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
+
+# Fast JSON encoding for API responses; the stdlib encoder is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -36,39 +71,134 @@ app = Flask(__name__,
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
-# Task results storage
-task_results = {}
+# Behind a proxy that honours X-Sendfile, let it send file bodies itself
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes jsonify() responses with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Event streams must reach the browser as they are written: no caching, and
+# no response buffering by a reverse proxy such as nginx
+EVENT_STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Streams each hold a server thread for as long as they are open; see MAX_EVENT_STREAMS
+event_stream_slots = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
+
+def event_stream_response(generate):
+    """Event stream response for generate(), or a 503 when every stream slot is taken"""
+    if not event_stream_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'error': 'Too many event streams, poll instead'}), 503
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers=EVENT_STREAM_HEADERS)
+    response.call_on_close(event_stream_slots.release)
+    return response
+
+# Host facts probed once at import instead of on every request
+SYSTEM_NAME = platform.system()
+PYTHON_VERSION = f"Python {platform.python_version()}"
+
+# The page treatment scripts ship with the app and never move, so check once
+MISSING_SCRIPTS = [script for script in ('analyzer.py', 'visualizer.py', 'picture_extractor.py')
+                   if not (Path(__file__).parent / 'page_treatment' / script).exists()]
+
+# Task results storage, written from worker threads. Oldest entries are
+# evicted past TASK_RESULTS_MAX and finished ones expire after TASK_RESULTS_TTL.
+task_results = OrderedDict()
+task_lock = threading.Lock()
+task_changed = threading.Condition(task_lock)
+
+# Task id of each running page step, keyed by (type, pdf path, page, options)
+inflight_tasks = {}
+
+def set_task_result(task_id, result):
+    """Store a task result, evicting the oldest tasks beyond TASK_RESULTS_MAX"""
+    with task_lock:
+        task_results[task_id] = result
+        task_results.move_to_end(task_id)
+        while len(task_results) > TASK_RESULTS_MAX:
+            task_results.popitem(last=False)
+        task_changed.notify_all()
+
+def expire_task_results():
+    """Drop finished tasks older than TASK_RESULTS_TTL; return how many"""
+    cutoff_time = time.time() - TASK_RESULTS_TTL
+    with task_lock:
+        old_tasks = [tid for tid, result in task_results.items()
+                     if result.get('done') and result.get('completed_at', 0) < cutoff_time]
+        for tid in old_tasks:
+            del task_results[tid]
+    return len(old_tasks)
+
+# Page steps run on a bounded pool instead of one new thread per request
+task_executor = ThreadPoolExecutor(max_workers=TASK_WORKERS, thread_name_prefix='task')
+
+# Working-directory PDF listing, keyed on the directory's mtime
+pdf_cache = {'mtime': None, 'files': []}
+pdf_cache_lock = threading.Lock()
 
 # Import batch processor if available
 try:
     from backend.batch_treatment.batch_processor import (
-        start_batch_processing, get_batch_processor, cleanup_old_batches
+        start_batch_processing, get_batch_processor, cleanup_old_batches, find_active_batch
     )
     batch_processing_available = True
 except ImportError:
     logger.warning("Batch processing not available")
     batch_processing_available = False
 
-# Ensure required directories exist
-ensure_results_folder()
+# Ensure required directories exist; routes reuse this path instead of
+# re-creating the folder on every request
+RESULTS_FOLDER = ensure_results_folder()
+PREVIEW_CACHE_FOLDER = ensure_results_folder(RESULTS_FOLDER / "previews")
 
 # Routes
+# Pages and assets answer If-None-Match/If-Modified-Since with 304 when unchanged
 @app.route('/')
 def index():
-    return send_file(frontend_path / 'index.html')
+    return send_from_directory(frontend_path, 'index.html', conditional=True, max_age=0)
 
 @app.route('/batch')
 def batch_interface():
-    return send_file(frontend_path / 'batch.html')
+    return send_from_directory(frontend_path, 'batch.html', conditional=True, max_age=0)
 
 @app.route('/static/<path:filename>')
 def serve_static(filename):
-    return send_file(frontend_path / 'static' / filename)
+    return send_from_directory(frontend_path / 'static', filename, conditional=True,
+                               max_age=STATIC_MAX_AGE)
+
+def list_pdf_files():
+    """List the PDFs in the working directory, rescanning only when it changes"""
+    mtime = os.stat('.').st_mtime_ns
+    with pdf_cache_lock:
+        if pdf_cache['mtime'] != mtime:
+            # The name test runs first; is_file() then answers from the
+            # directory entry type, needing a stat only for symlinks
+            with os.scandir('.') as it:
+                pdf_cache['files'] = [entry.name for entry in it
+                                      if entry.name.endswith('.pdf') and entry.is_file()]
+            pdf_cache['mtime'] = mtime
+        return list(pdf_cache['files'])
+
+def is_known_pdf(pdf_file):
+    """True only for a PDF of the working directory listing; rejects other paths"""
+    return bool(pdf_file) and pdf_file in list_pdf_files()
 
 @app.route('/pdf-files')
 def pdf_files():
     try:
-        pdf_files = [f for f in os.listdir('.') if f.endswith('.pdf')]
+        pdf_files = list_pdf_files()
         logger.info(f"Found {len(pdf_files)} PDF files")
         return jsonify(pdf_files)
     except Exception as e:
@@ -79,139 +209,286 @@ def pdf_files():
 def pdf_info(pdf_file):
     """Get information about a PDF file"""
     try:
-        if not os.path.exists(pdf_file):
+        if not is_known_pdf(pdf_file):
+            return jsonify({'error': f'PDF file not found: {pdf_file}'}), 404
+
+        # One stat answers both "does it exist" and "how big is it"
+        try:
+            file_size = os.stat(pdf_file).st_size
+        except FileNotFoundError:
             return jsonify({'error': f'PDF file not found: {pdf_file}'}), 404
 
         page_count = count_pdf_pages(pdf_file)
         return jsonify({
             'pageCount': page_count,
             'filename': os.path.basename(pdf_file),
-            'size': os.path.getsize(pdf_file)
+            'size': file_size
         })
     except Exception as e:
         logger.error(f"Error getting PDF info: {e}")
         return jsonify({'error': str(e)}), 500
 
+def preview_cache_name(pdf_file, pdf_stat, page_num):
+    """Cache file name for a page preview; a rewritten PDF gets new names"""
+    key = f"{os.path.abspath(pdf_file)}:{pdf_stat.st_mtime_ns}:{page_num}:{PREVIEW_DPI}"
+    return hashlib.sha1(key.encode()).hexdigest() + ".jpg"
+
+def evict_preview_cache():
+    """Delete least recently served previews until the cache fits PREVIEW_CACHE_MAX_BYTES"""
+    entries = []
+    total_size = 0
+    with os.scandir(PREVIEW_CACHE_FOLDER) as it:
+        for entry in it:
+            if entry.is_file():
+                stats = entry.stat()
+                entries.append((stats.st_atime, stats.st_size, entry.path))
+                total_size += stats.st_size
+
+    if total_size <= PREVIEW_CACHE_MAX_BYTES:
+        return
+
+    entries.sort()
+    for _, size, path in entries:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        if total_size <= PREVIEW_CACHE_MAX_BYTES:
+            break
+
+def preview_dpi(page_width_pt):
+    """Highest DPI up to PREVIEW_DPI at which a page fits PREVIEW_MAX_WIDTH pixels"""
+    if not page_width_pt:
+        return PREVIEW_DPI
+    # Round down so rounding in the rasterizer cannot overshoot the width
+    return min(PREVIEW_DPI, int(PREVIEW_MAX_WIDTH * 72 / page_width_pt))
+
+@lru_cache(maxsize=64)
+def pdf_page_width(pdf_file, mtime_ns):
+    """Page width in points as reported by pdfinfo; mtime_ns keys out stale entries"""
+    try:
+        # "Page size:      612 x 792 pts (letter)"
+        return float(pdf2image.pdfinfo_from_path(pdf_file)['Page size'].split()[0])
+    except Exception as e:
+        logger.warning(f"Could not read page size of {pdf_file}: {e}")
+        return None
+
+def render_preview(pdf_file, page_num, cache_name):
+    """
+    Render a page preview JPEG under a temporary name in the preview cache.
+
+    PyMuPDF renders in this process; without it pdftocairo is forked and
+    writes the JPEG itself. Returns the temporary path, or None when the
+    page could not be rendered.
+    """
+    tmp_name = f"{cache_name}.{uuid.uuid4().hex}.tmp"
+
+    # Rasterize straight at the resolution that fits PREVIEW_MAX_WIDTH; the
+    # resize below only remains as a guard for pages wider than expected
+    if fitz is not None:
+        with fitz.open(pdf_file) as doc:
+            if not 1 <= page_num <= doc.page_count:
+                return None
+            dpi = preview_dpi(doc.load_page(page_num - 1).rect.width)
+            pil_image = render_pdf_page(doc, page_num, dpi)
+        tmp_path = PREVIEW_CACHE_FOLDER / f"{tmp_name}.jpg"
+    else:
+        # Let pdftocairo write the JPEG straight into the cache folder;
+        # PIL only touches the file when the page needs downscaling
+        dpi = preview_dpi(pdf_page_width(pdf_file, os.stat(pdf_file).st_mtime_ns))
+        pdf_images = pdf2image.convert_from_path(
+            pdf_file, dpi=dpi,
+            first_page=page_num, last_page=page_num,
+            fmt='jpeg', jpegopt={'quality': JPEG_QUALITY, 'progressive': True},
+            use_pdftocairo=True, output_folder=PREVIEW_CACHE_FOLDER,
+            output_file=tmp_name, single_file=True, paths_only=True
+        )
+        if not pdf_images:
+            return None
+        tmp_path = pdf_images[0]
+        pil_image = Image.open(tmp_path)
+
+    with pil_image:
+        # Resize if too large
+        if pil_image.width > PREVIEW_MAX_WIDTH:
+            ratio = PREVIEW_MAX_WIDTH / pil_image.width
+            new_height = int(pil_image.height * ratio)
+            pil_image = pil_image.resize((PREVIEW_MAX_WIDTH, new_height), Image.BILINEAR)
+        elif fitz is None:
+            return tmp_path
+        pil_image.save(tmp_path, 'JPEG', quality=JPEG_QUALITY, progressive=True)
+
+    return tmp_path
+
 @app.route('/pdf-preview/<pdf_file>/<int:page_num>')
 def pdf_preview(pdf_file, page_num):
     """Generate and serve a preview image of a PDF page"""
     try:
-        import pdf2image
-        from PIL import Image
-        import io
-
-        if not os.path.exists(pdf_file):
+        if not is_known_pdf(pdf_file):
             return jsonify({'error': f'PDF file not found: {pdf_file}'}), 404
 
-        logger.info(f"Generating preview for {pdf_file} page {page_num}")
+        try:
+            pdf_stat = os.stat(pdf_file)
+        except FileNotFoundError:
+            return jsonify({'error': f'PDF file not found: {pdf_file}'}), 404
 
-        # Convert PDF page to image
-        pdf_images = pdf2image.convert_from_path(
-            pdf_file, dpi=PREVIEW_DPI,
-            first_page=page_num, last_page=page_num
-        )
+        cache_name = preview_cache_name(pdf_file, pdf_stat, page_num)
+        cache_path = PREVIEW_CACHE_FOLDER / cache_name
 
-        if not pdf_images:
-            return jsonify({'error': f'Could not extract page {page_num}'}), 400
+        try:
+            # Record the hit in atime only: mtime feeds the ETag/Last-Modified
+            os.utime(cache_path, (time.time(), os.stat(cache_path).st_mtime))
+        except FileNotFoundError:
+            logger.info(f"Generating preview for {pdf_file} page {page_num}")
 
-        pil_image = pdf_images[0]
+            tmp_path = render_preview(pdf_file, page_num, cache_name)
+            if tmp_path is None:
+                return jsonify({'error': f'Could not extract page {page_num}'}), 400
 
-        # Resize if too large
-        max_width = 1200
-        if pil_image.width > max_width:
-            ratio = max_width / pil_image.width
-            new_height = int(pil_image.height * ratio)
-            pil_image = pil_image.resize((max_width, new_height), Image.LANCZOS)
+            # Rename into place, so concurrent requests never serve a
+            # half-written preview
+            os.replace(tmp_path, cache_path)
+            evict_preview_cache()
 
-        # Convert to bytes
-        img_io = io.BytesIO()
-        pil_image.save(img_io, 'PNG', optimize=True)
-        img_io.seek(0)
-
-        return send_file(img_io, mimetype='image/png')
+        return send_from_directory(PREVIEW_CACHE_FOLDER, cache_name, mimetype='image/jpeg',
+                                   conditional=True, max_age=PREVIEW_MAX_AGE)
 
     except Exception as e:
         logger.error(f"Error generating PDF preview: {e}")
         return jsonify({'error': str(e)}), 500
 
-def run_command(task_id, command):
-    """Run a command in a background thread and store result"""
-    logger.info(f"Running command: {command}")
+def parse_page_number(value, default=1):
+    """Page number from a form field (default when absent); None unless a positive integer"""
+    if value is None:
+        return default
     try:
-        # Run the command with pipe input to automatically answer "n" to prompts
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            universal_newlines=True
-        )
-
-        # Send "n" to the process to bypass prompts
-        stdout, stderr = process.communicate(input="n\n")
-
-        # Log output for debugging
-        logger.info(f"Command stdout: {stdout[:500]}...")
-        if stderr:
-            logger.error(f"Command stderr: {stderr}")
+        page_num = int(value, 10)
+    except ValueError:
+        return None
+    return page_num if page_num >= 1 else None
+
+def doctags_path_for(pdf_file, page_num):
+    """DocTags file of one PDF page, so pages and PDFs never share a file"""
+    return RESULTS_FOLDER / f"{Path(pdf_file).stem}_page{page_num}.doctags.txt"
+
+def visualization_path_for(pdf_file, page_num):
+    """Visualization image of one PDF page, named like its DocTags file"""
+    return RESULTS_FOLDER / f"{Path(pdf_file).stem}_visualization_page_{page_num}.png"
+
+def analyze_page(pdf_file, page_num, adjust=False):
+    """Analyze one page in-process and write its DocTags file"""
+    deadline = time.monotonic() + PROCESSING_TIMEOUT
+    try:
+        doctags = analyzer.run_analyzer(pdf_file, page_num, doctags_path_for(pdf_file, page_num),
+                                        should_stop=lambda: time.monotonic() > deadline)
+    except analyzer.AnalysisCancelled:
+        raise TimeoutError(f"Analyzer timed out after {PROCESSING_TIMEOUT} seconds")
+    return f"Analyzed page {page_num}: {len(doctags)} characters of DocTags"
+
+def visualize_page(pdf_file, page_num, adjust=False):
+    """Draw the zones of a page's DocTags file onto the page"""
+    output_path = visualization_path_for(pdf_file, page_num)
+    visualizer.process_page(pdf_file, page_num, doctags_path_for(pdf_file, page_num),
+                            output_path, DEFAULT_DPI, adjust)
+    return f"Visualization saved to: {output_path}"
+
+def extract_page(pdf_file, page_num, adjust=False):
+    """Extract the pictures of one page into results/pictures"""
+    saved_files = picture_extractor.run_extractor(doctags_path_for(pdf_file, page_num),
+                                                  pdf_file, page_num, RESULTS_FOLDER / "pictures",
+                                                  adjust=adjust)
+    return f"Extracted {len(saved_files)} pictures from page {page_num}"
+
+# In-process page steps; the model and imports stay loaded between requests
+PAGE_TASKS = {
+    'analyzer': analyze_page,
+    'visualizer': visualize_page,
+    'extractor': extract_page,
+}
+
+def start_task(task_type, task_id, running_message, func, *args):
+    """
+    Queue a page step and return its task id.
+
+    An identical step (same type, PDF, page and options) that is still
+    running is not started twice; its task id is returned instead.
+    """
+    key = (task_type, os.path.abspath(args[0])) + args[1:]
+    with task_lock:
+        running_id = inflight_tasks.get(key)
+        if running_id is not None:
+            logger.info(f"Reusing running task {running_id} for {key}")
+            return running_id
+        inflight_tasks[key] = task_id
+
+    # Page steps take (pdf_file, page_num, ...); record their files now
+    # instead of guessing them once the task is done
+    task_files = {'doctags_file': f"{RESULTS_DIR}/{doctags_path_for(args[0], args[1]).name}"}
+    if task_type == 'visualizer':
+        task_files['image_file'] = f"{RESULTS_DIR}/{visualization_path_for(args[0], args[1]).name}"
+
+    # Initialize task result
+    set_task_result(task_id, {
+        'success': None,
+        'output': running_message,
+        'done': False,
+        **task_files
+    })
+
+    # Queue on the shared worker pool
+    task_executor.submit(run_task, task_id, key, task_files, func, *args)
+    return task_id
+
+def run_task(task_id, key, task_files, func, *args):
+    """Run a page step in a background thread and store result"""
+    logger.info(f"Running task {task_id}: {func.__name__}{args}")
+    try:
+        output = func(*args)
 
-        # Update task result
-        if process.returncode == 0:
-            task_results[task_id] = {
-                'success': True,
-                'output': stdout,
-                'done': True
-            }
-            logger.info(f"Command completed successfully: {task_id}")
-        else:
-            error_message = stderr or f"Command failed with return code {process.returncode}"
-            task_results[task_id] = {
-                'success': False,
-                'error': error_message,
-                'done': True
-            }
-            logger.error(f"Command failed: {task_id} - {error_message}")
+        set_task_result(task_id, {
+            'success': True,
+            'output': output[-TASK_OUTPUT_TAIL:],
+            'done': True,
+            'completed_at': time.time(),
+            **task_files
+        })
+        logger.info(f"Task completed successfully: {task_id}")
 
     except Exception as e:
-        import traceback
-        logger.error(f"Unexpected error: {task_id} - {str(e)}")
+        logger.error(f"Task failed: {task_id} - {str(e)}")
         logger.error(traceback.format_exc())
-        task_results[task_id] = {
+        set_task_result(task_id, {
             'success': False,
-            'error': f"Exception: {str(e)}",
-            'done': True
-        }
+            'error': str(e)[-TASK_OUTPUT_TAIL:],
+            'done': True,
+            'completed_at': time.time(),
+            **task_files
+        })
+
+    finally:
+        with task_lock:
+            inflight_tasks.pop(key, None)
 
 @app.route('/run-analyzer', methods=['POST'])
 def run_analyzer():
     try:
         pdf_file = request.form.get('pdf_file')
-        page_num = request.form.get('page_num', 1)
+        page_num = parse_page_number(request.form.get('page_num'))
+        if page_num is None:
+            return jsonify({'success': False, 'error': 'Invalid page number'}), 400
 
         if not pdf_file:
             return jsonify({'success': False, 'error': 'PDF file not specified'}), 400
 
-        if not os.path.exists(pdf_file):
+        if not is_known_pdf(pdf_file):
             return jsonify({'success': False, 'error': f'PDF file not found: {pdf_file}'}), 404
 
-        command = f"python backend/page_treatment/analyzer.py --image {pdf_file} --page {page_num} --start-page {page_num} --end-page {page_num}"
-
-        # Generate task ID
-        task_id = f"analyzer_{int(time.time())}"
+        # Generate a unique task ID; the type prefix stays readable in logs
+        task_id = f"analyzer_{uuid.uuid4().hex}"
 
-        # Initialize task result
-        task_results[task_id] = {
-            'success': None,
-            'output': "Running analyzer...",
-            'done': False
-        }
-
-        # Start background thread
-        thread = threading.Thread(target=run_command, args=(task_id, command))
-        thread.daemon = True
-        thread.start()
+        task_id = start_task('analyzer', task_id, "Running analyzer...",
+                             analyze_page, pdf_file, page_num)
 
         return jsonify({
             'success': True,
@@ -227,30 +504,22 @@ def run_analyzer():
 def run_visualizer():
     try:
         pdf_file = request.form.get('pdf_file')
-        page_num = request.form.get('page_num', 1)
+        page_num = parse_page_number(request.form.get('page_num'))
+        if page_num is None:
+            return jsonify({'success': False, 'error': 'Invalid page number'}), 400
         adjust = request.form.get('adjust') == 'true'
 
         if not pdf_file:
             return jsonify({'success': False, 'error': 'PDF file not specified'}), 400
 
-        command = f"python backend/page_treatment/visualizer.py --doctags results/output.doctags.txt --pdf {pdf_file} --page {page_num}"
-        if adjust:
-            command += " --adjust"
-
-        # Generate task ID with page number
-        task_id = f"visualizer_{int(time.time())}_{page_num}"
+        if not is_known_pdf(pdf_file):
+            return jsonify({'success': False, 'error': f'PDF file not found: {pdf_file}'}), 404
 
-        # Initialize task result
-        task_results[task_id] = {
-            'success': None,
-            'output': "Running visualizer...",
-            'done': False
-        }
+        # Generate a unique task ID; the type prefix stays readable in logs
+        task_id = f"visualizer_{uuid.uuid4().hex}"
 
-        # Start background thread
-        thread = threading.Thread(target=run_command, args=(task_id, command))
-        thread.daemon = True
-        thread.start()
+        task_id = start_task('visualizer', task_id, "Running visualizer...",
+                             visualize_page, pdf_file, page_num, adjust)
 
         return jsonify({
             'success': True,
@@ -266,30 +535,22 @@ def run_visualizer():
 def run_extractor():
     try:
         pdf_file = request.form.get('pdf_file')
-        page_num = request.form.get('page_num', 1)
+        page_num = parse_page_number(request.form.get('page_num'))
+        if page_num is None:
+            return jsonify({'success': False, 'error': 'Invalid page number'}), 400
         adjust = request.form.get('adjust') == 'true'
 
         if not pdf_file:
             return jsonify({'success': False, 'error': 'PDF file not specified'}), 400
 
-        command = f"python backend/page_treatment/picture_extractor.py --doctags results/output.doctags.txt --pdf {pdf_file} --page {page_num}"
-        if adjust:
-            command += " --adjust"
+        if not is_known_pdf(pdf_file):
+            return jsonify({'success': False, 'error': f'PDF file not found: {pdf_file}'}), 404
 
-        # Generate task ID with page number
-        task_id = f"extractor_{int(time.time())}_{page_num}"
+        # Generate a unique task ID; the type prefix stays readable in logs
+        task_id = f"extractor_{uuid.uuid4().hex}"
 
-        # Initialize task result
-        task_results[task_id] = {
-            'success': None,
-            'output': "Running picture extractor...",
-            'done': False
-        }
-
-        # Start background thread
-        thread = threading.Thread(target=run_command, args=(task_id, command))
-        thread.daemon = True
-        thread.start()
+        task_id = start_task('extractor', task_id, "Running picture extractor...",
+                             extract_page, pdf_file, page_num, adjust)
 
         return jsonify({
             'success': True,
@@ -305,34 +566,28 @@ def run_processing_task(task_type, form_data):
     """Generic function to run processing tasks"""
     try:
         pdf_file = form_data.get('pdf_file')
-        page_num = form_data.get('page_num', '1')
+        page_num = parse_page_number(form_data.get('page_num'))
+        if page_num is None:
+            return jsonify({'success': False, 'error': 'Invalid page number'}), 400
+        adjust = form_data.get('adjust') == 'true'
 
         if not pdf_file:
             return jsonify({'success': False, 'error': 'PDF file not specified'}), 400
 
-        if not os.path.exists(pdf_file):
+        if not is_known_pdf(pdf_file):
             return jsonify({'success': False, 'error': f'PDF file not found: {pdf_file}'}), 404
 
-        # Build command based on task type
-        command = build_command(task_type, pdf_file, page_num, form_data)
-
-        # Generate task ID with page number
-        task_id = f"{task_type}_{int(time.time() * 1000)}_{page_num}"
+        task = PAGE_TASKS.get(task_type)
+        if task is None:
+            raise ValueError(f"Unknown task type: {task_type}")
 
-        # Initialize task result
-        with task_lock:
-            task_results[task_id] = {
-                'success': None,
-                'output': f"Running {task_type}...",
-                'done': False
-            }
+        # Generate a unique task ID; the type prefix stays readable in logs
+        task_id = f"{task_type}_{uuid.uuid4().hex}"
 
-        logger.info(f"Created task {task_id} for {task_type} on page {page_num}")
+        task_id = start_task(task_type, task_id, f"Running {task_type}...",
+                             task, pdf_file, page_num, adjust)
 
-        # Start background thread
-        thread = threading.Thread(target=run_background_task, args=(task_id, command))
-        thread.daemon = True
-        thread.start()
+        logger.info(f"Started task {task_id} for {task_type} on page {page_num}")
 
         return jsonify({
             'success': True,
@@ -342,77 +597,71 @@ def run_processing_task(task_type, form_data):
 
     except Exception as e:
         logger.error(f"Error starting {task_type}: {e}")
-        import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def build_command(task_type, pdf_file, page_num, form_data):
-    """Build command for different task types"""
-    adjust = form_data.get('adjust') == 'true'
+def get_task_result(task_id):
+    """Copy of a task result, or None if unknown"""
+    with task_lock:
+        result = task_results.get(task_id)
+        if result is not None:
+            result = result.copy()
 
-    if task_type == 'analyzer':
-        return (f"python backend/page_treatment/analyzer.py --image {pdf_file} "
-                f"--page {page_num} --start-page {page_num} --end-page {page_num}")
-
-    elif task_type == 'visualizer':
-        cmd = (f"python backend/page_treatment/visualizer.py "
-               f"--doctags results/output.doctags.txt --pdf {pdf_file} --page {page_num}")
-        if adjust:
-            cmd += " --adjust"
-        return cmd
-
-    elif task_type == 'extractor':
-        cmd = (f"python backend/page_treatment/picture_extractor.py "
-               f"--doctags results/output.doctags.txt --pdf {pdf_file} --page {page_num}")
-        if adjust:
-            cmd += " --adjust"
-        return cmd
-
-    else:
-        raise ValueError(f"Unknown task type: {task_type}")
+    return result
 
 @app.route('/task-status/<task_id>')
 def task_status(task_id):
-    if task_id not in task_results:
+    result = get_task_result(task_id)
+
+    if result is None:
         logger.warning(f"Task {task_id} not found in task_results")
         return jsonify({'success': False, 'error': 'Task not found'}), 404
 
-    result = task_results[task_id].copy()
-
     # Log the complete result for debugging
     logger.info(f"Task {task_id} result: {result}")
 
-    # If task is completed successfully, add file paths
-    if result.get('done') and result.get('success'):
-        if task_id.startswith('analyzer_'):
-            doctags_path = Path("results") / "output.doctags.txt"
-            if doctags_path.exists():
-                result['doctags_file'] = "results/output.doctags.txt"
-                logger.info(f"Added doctags_file to result")
-            else:
-                logger.warning(f"DocTags file not found: {doctags_path}")
+    return jsonify(result)
 
-        elif task_id.startswith('visualizer_'):
-            # Extract page number from the end of task_id if it exists
-            page_num = task_id.split('_')[-1] if len(task_id.split('_')) > 2 else "1"
-            viz_filename = f"visualization_page_{page_num}.png"
-            result['image_file'] = f"results/{viz_filename}"
-            logger.info(f"Found visualization at: {result['image_file']}")
+@app.route('/task-events/<task_id>')
+def task_events(task_id):
+    """Stream a task's status as Server-Sent Events: now, and once it is done"""
+    if get_task_result(task_id) is None:
+        return jsonify({'success': False, 'error': 'Task not found'}), 404
 
-    return jsonify(result)
+    def task_finished():
+        result = task_results.get(task_id)
+        return result is None or result.get('done')
+
+    def generate():
+        yield f"data: {app.json.dumps(get_task_result(task_id))}\n\n"
+        while True:
+            with task_lock:
+                finished = task_changed.wait_for(task_finished, BATCH_EVENT_HEARTBEAT)
+            if not finished:
+                # Comment line keeps the idle connection open
+                yield ": heartbeat\n\n"
+                continue
+
+            result = get_task_result(task_id)
+            if result is None:
+                result = {'success': False, 'error': 'Task not found', 'done': True}
+            yield f"data: {app.json.dumps(result)}\n\n"
+            break
+
+    return event_stream_response(generate)
 
 @app.route('/results/<path:filename>')
 def serve_results(filename):
     """Serve files from results directory"""
     try:
-        results_dir = ensure_results_folder()
-        file_path = results_dir / filename
+        # Result files are rewritten in place, so let browsers keep them but
+        # revalidate: an unchanged file costs a 304 instead of a full transfer.
+        # send_from_directory also refuses paths that escape the results folder.
+        return send_from_directory(RESULTS_FOLDER, filename, conditional=True, max_age=0)
 
-        if file_path.exists() and file_path.is_file():
-            return send_file(file_path)
-        else:
-            logger.error(f"File not found: {file_path}")
-            return jsonify({'error': f"File not found: {filename}"}), 404
+    except NotFound:
+        logger.error(f"File not found: {RESULTS_FOLDER / filename}")
+        return jsonify({'error': f"File not found: {filename}"}), 404
 
     except Exception as e:
         logger.error(f"Error serving file {filename}: {e}")
@@ -422,35 +671,30 @@ def serve_results(filename):
 def check_environment():
     """Check system environment and configuration"""
     try:
-        import subprocess
-
-        # Check for required scripts
-        required_scripts = ['analyzer.py', 'visualizer.py', 'picture_extractor.py']
-        backend_dir = Path('backend/page_treatment')
-        missing_scripts = [s for s in required_scripts if not (backend_dir / s).exists()]
-
-        # Get Python version
-        result = subprocess.run(['python', '--version'], capture_output=True, text=True)
-        python_version = result.stdout.strip() if result.returncode == 0 else "Unknown"
-
         # Check results directory
-        results_dir = ensure_results_folder()
+        results_dir = RESULTS_FOLDER
 
-        return jsonify({
+        environment = {
             'cwd': os.getcwd(),
-            'files': os.listdir('.')[:50],  # Limit to 50 files
-            'missing_scripts': missing_scripts,
-            'pdf_files': [f for f in os.listdir('.') if f.endswith('.pdf')],
+            'missing_scripts': MISSING_SCRIPTS,
+            'pdf_files': list_pdf_files(),
             'results_dir_exists': results_dir.exists(),
             'results_dir_writable': os.access(results_dir, os.W_OK),
-            'python_version': python_version,
+            'python_version': PYTHON_VERSION,
             'batch_processing_available': batch_processing_available
-        })
+        }
+        # Raw directory listing is for debugging only
+        if app.debug:
+            environment['files'] = os.listdir('.')[:50]  # Limit to 50 files
+
+        return jsonify(environment)
 
     except Exception as e:
         logger.error(f"Error checking environment: {e}")
         return jsonify({'error': str(e)}), 500
 
+MANUAL_COMMAND_SCRIPTS = {'analyzer.py', 'visualizer.py', 'picture_extractor.py'}
+
 @app.route('/run-manual-command', methods=['POST'])
 def run_manual_command():
     """Run a manual command for debugging"""
@@ -461,12 +705,18 @@ def run_manual_command():
 
         logger.info(f"Running manual command: {command}")
 
-        # Update paths in command if needed
-        if 'backend/page_treatment/' not in command:
-            for script in ['analyzer.py', 'visualizer.py', 'picture_extractor.py']:
-                command = command.replace(script, f'backend/page_treatment/{script}')
+        # Only the page treatment scripts may run, without a shell in between
+        argv = shlex.split(command)
+        if (len(argv) < 2 or argv[0] not in ('python', 'python3')
+                or Path(argv[1]).name not in MANUAL_COMMAND_SCRIPTS):
+            return jsonify({
+                'success': False,
+                'error': f"Only these scripts can be run: {', '.join(sorted(MANUAL_COMMAND_SCRIPTS))}"
+            }), 400
 
-        success, stdout, stderr = run_command_with_timeout(command, 60)
+        argv = [sys.executable, str(Path('backend/page_treatment') / Path(argv[1]).name)] + argv[2:]
+
+        success, stdout, stderr = run_command_with_timeout(argv, 60)
 
         return jsonify({
             'success': success,
@@ -485,24 +735,22 @@ if batch_processing_available:
         """Start batch processing job"""
         try:
             pdf_file = request.form.get('pdf_file')
-            start_page = int(request.form.get('start_page', 1))
-            end_page = int(request.form.get('end_page', 1))
+            start_page = parse_page_number(request.form.get('start_page'))
+            end_page = parse_page_number(request.form.get('end_page'))
+            if start_page is None or end_page is None or end_page < start_page:
+                return jsonify({'success': False, 'error': 'Invalid page range'}), 400
 
-            if not pdf_file or not os.path.exists(pdf_file):
+            if not is_known_pdf(pdf_file):
                 return jsonify({'success': False, 'error': 'Invalid PDF file'}), 400
 
             # Check if there's already an active batch for this PDF
-            from backend.batch_treatment.batch_processor import batch_processors, batch_lock
-            with batch_lock:
-                for batch_id, processor in batch_processors.items():
-                    if (processor.pdf_file == pdf_file and
-                            not processor.state['completed'] and
-                            not processor.state['cancelled']):
-                        return jsonify({
-                            'success': False,
-                            'error': 'A batch process is already running for this PDF',
-                            'existing_batch_id': batch_id
-                        }), 409
+            existing_batch_id = find_active_batch(pdf_file)
+            if existing_batch_id:
+                return jsonify({
+                    'success': False,
+                    'error': 'A batch process is already running for this PDF',
+                    'existing_batch_id': existing_batch_id
+                }), 409
 
             options = {
                 'adjust': request.form.get('adjust') == 'true',
@@ -536,6 +784,33 @@ if batch_processing_available:
         state['logs'] = state['logs'][-20:]  # Last 20 logs only
         return jsonify(state)
 
+    @app.route('/batch-events/<batch_id>')
+    def batch_events(batch_id):
+        """Stream batch status as Server-Sent Events each time it changes"""
+        processor = get_batch_processor(batch_id)
+        if not processor:
+            return jsonify({'error': 'Batch not found'}), 404
+
+        def generate():
+            version = -1
+            while True:
+                new_version = processor.wait_for_update(version, BATCH_EVENT_HEARTBEAT)
+                if new_version == version:
+                    # Comment line keeps the idle connection open
+                    yield ": heartbeat\n\n"
+                    continue
+
+                # Bursts of changes collapse into one snapshot of the latest state
+                version = new_version
+                state = processor.get_state()
+                state['logs'] = state['logs'][-20:]  # Last 20 logs only
+                yield f"data: {app.json.dumps(state)}\n\n"
+
+                if state['completed']:
+                    break
+
+        return event_stream_response(generate)
+
 
 # Add these routes to your app.py file after the other batch processing endpoints
 
@@ -546,7 +821,7 @@ def batch_report(batch_id):
         processor = get_batch_processor(batch_id)
         if not processor:
             # Try to find existing report even if processor is gone
-            report_path = ensure_results_folder() / f"batch_{batch_id}" / "report.html"
+            report_path = RESULTS_FOLDER / f"batch_{batch_id}" / "report.html"
             if report_path.exists():
                 return send_file(report_path)
             else:
@@ -568,12 +843,11 @@ def batch_report(batch_id):
 def batch_report_image(batch_id, image_name):
     """Serve images from batch report directory"""
     try:
-        image_path = ensure_results_folder() / f"batch_{batch_id}" / image_name
+        return send_from_directory(RESULTS_FOLDER / f"batch_{batch_id}", image_name,
+                                   conditional=True, max_age=0)
 
-        if not image_path.exists():
-            return jsonify({'error': 'Image not found'}), 404
-
-        return send_file(image_path)
+    except NotFound:
+        return jsonify({'error': 'Image not found'}), 404
 
     except Exception as e:
         logger.error(f"Error serving batch image: {e}")
@@ -631,7 +905,7 @@ def download_batch_results(batch_id):
         processor = get_batch_processor(batch_id)
         if not processor:
             # Try to find existing results
-            batch_dir = ensure_results_folder() / f"batch_{batch_id}"
+            batch_dir = RESULTS_FOLDER / f"batch_{batch_id}"
             if not batch_dir.exists():
                 return jsonify({'error': 'Batch results not found'}), 404
 
@@ -642,7 +916,6 @@ def download_batch_results(batch_id):
                     self.results_dir = batch_dir
 
                 def create_zip_archive(self):
-                    import zipfile
                     zip_path = self.results_dir / f"batch_results_{self.batch_id}.zip"
                     with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
                         for file_path in self.results_dir.rglob('*'):
@@ -673,44 +946,27 @@ def retry_page():
     """Retry processing a failed page"""
     try:
         pdf_file = request.form.get('pdf_file')
-        page_num = int(request.form.get('page_num'))
+        page_num = parse_page_number(request.form.get('page_num'), default=None)
+        if page_num is None:
+            return jsonify({'success': False, 'error': 'Invalid page number'}), 400
         adjust = request.form.get('adjust') == 'true'
 
-        if not pdf_file or not os.path.exists(pdf_file):
+        if not is_known_pdf(pdf_file):
             return jsonify({'success': False, 'error': 'Invalid PDF file'}), 400
 
         # Run the three processing steps
         results = {'success': True, 'errors': []}
 
-        # Step 1: Analyzer
-        command = (f"python backend/page_treatment/analyzer.py --image {pdf_file} "
-                   f"--page {page_num} --start-page {page_num} --end-page {page_num}")
-        success, stdout, stderr = run_command_with_timeout(command, 60)
-        if not success:
-            results['errors'].append(f"Analyzer: {stderr}")
-            results['success'] = False
-
-        # Step 2: Visualizer (only if analyzer succeeded)
-        if results['success']:
-            command = (f"python backend/page_treatment/visualizer.py "
-                       f"--doctags results/output.doctags.txt --pdf {pdf_file} --page {page_num}")
-            if adjust:
-                command += " --adjust"
-            success, stdout, stderr = run_command_with_timeout(command, 60)
-            if not success:
-                results['errors'].append(f"Visualizer: {stderr}")
-                results['success'] = False
-
-        # Step 3: Extractor (only if previous steps succeeded)
-        if results['success']:
-            command = (f"python backend/page_treatment/picture_extractor.py "
-                       f"--doctags results/output.doctags.txt --pdf {pdf_file} --page {page_num}")
-            if adjust:
-                command += " --adjust"
-            success, stdout, stderr = run_command_with_timeout(command, 60)
-            if not success:
-                results['errors'].append(f"Extractor: {stderr}")
+        for label, step in (('Analyzer', analyze_page), ('Visualizer', visualize_page),
+                            ('Extractor', extract_page)):
+            try:
+                step(pdf_file, page_num, adjust)
+            except Exception as e:
+                results['errors'].append(f"{label}: {e}")
                 # Don't fail completely if just extractor fails
+                if step is not extract_page:
+                    results['success'] = False
+                break
 
         if results['success']:
             return jsonify({'success': True})
@@ -728,14 +984,11 @@ def retry_page():
 def open_results_folder():
     """Open the results folder in the system file explorer"""
     try:
-        import platform
-        import subprocess
-
-        results_dir = ensure_results_folder()
+        results_dir = RESULTS_FOLDER
 
-        if platform.system() == 'Windows':
+        if SYSTEM_NAME == 'Windows':
             os.startfile(str(results_dir))
-        elif platform.system() == 'Darwin':  # macOS
+        elif SYSTEM_NAME == 'Darwin':  # macOS
             subprocess.Popen(['open', str(results_dir)])
         else:  # Linux and others
             subprocess.Popen(['xdg-open', str(results_dir)])
@@ -747,7 +1000,7 @@ def open_results_folder():
         return jsonify({
             'success': False,
             'error': 'Could not open folder automatically. ' +
-                     f'Please navigate to: {ensure_results_folder()}'
+                     f'Please navigate to: {RESULTS_FOLDER}'
         })
 
 # API endpoints for file upload
@@ -755,11 +1008,16 @@ def open_results_folder():
 def api_upload_doctags():
     """Simple API endpoint for getting DocTags from uploaded PDF"""
     uploaded_file_path = None
+    doctags_path = None
 
     try:
         if 'file' not in request.files:
             return jsonify({'success': False, 'error': 'No file provided'}), 400
 
+        page_num = parse_page_number(request.form.get('page_num'))
+        if page_num is None:
+            return jsonify({'success': False, 'error': 'Invalid page number'}), 400
+
         file = request.files['file']
         success, result = default_handler.save_uploaded_file(file, permanent=True)
 
@@ -767,29 +1025,24 @@ def api_upload_doctags():
             return jsonify({'success': False, 'error': result.get('error')}), 400
 
         uploaded_file_path = result['filepath']
-        page_num = request.form.get('page_num', '1')
-
-        # Run analyzer
-        command = (f"python backend/page_treatment/analyzer.py --image {uploaded_file_path} "
-                   f"--page {page_num} --start-page {page_num} --end-page {page_num}")
 
-        success, stdout, stderr = run_command_with_timeout(command, 60, "n\n")
-
-        if not success:
-            return jsonify({'success': False, 'error': 'Analysis failed', 'details': stderr}), 500
-
-        # Read doctags
-        doctags_path = ensure_results_folder() / "output.doctags.txt"
-        if not doctags_path.exists():
-            return jsonify({'success': False, 'error': 'DocTags not generated'}), 500
-
-        with open(doctags_path, 'r', encoding='utf-8') as f:
-            doctags_content = f.read()
+        # Run analyzer in-process; it returns the DocTags it wrote. The upload
+        # name is unique, so concurrent uploads never share a DocTags file.
+        doctags_path = doctags_path_for(uploaded_file_path, page_num)
+        deadline = time.monotonic() + PROCESSING_TIMEOUT
+        try:
+            doctags_content = analyzer.run_analyzer(uploaded_file_path, page_num, doctags_path,
+                                                    should_stop=lambda: time.monotonic() > deadline)
+        except analyzer.AnalysisCancelled:
+            return jsonify({'success': False, 'error': 'Analysis timed out',
+                            'details': f"Analyzer timed out after {PROCESSING_TIMEOUT} seconds"}), 504
+        except Exception as e:
+            return jsonify({'success': False, 'error': 'Analysis failed', 'details': str(e)}), 500
 
         return jsonify({
             'success': True,
             'filename': result['filename'],
-            'page': int(page_num),
+            'page': page_num,
             'doctags': doctags_content
         })
 
@@ -805,6 +1058,8 @@ def api_upload_doctags():
                 logger.info(f"Cleaned up: {uploaded_file_path}")
             except Exception as e:
                 logger.error(f"Cleanup error: {e}")
+        if doctags_path:
+            doctags_path.unlink(missing_ok=True)
 
 # Cleanup task
 def cleanup_old_files():
@@ -818,14 +1073,9 @@ def cleanup_old_files():
                 logger.info(f"Cleaned up {removed} old files")
 
             # Cleanup old tasks
-            with task_lock:
-                cutoff_time = time.time() - (CLEANUP_AGE_HOURS * 3600)
-                old_tasks = [tid for tid, result in task_results.items()
-                             if result.get('done') and tid.split('_')[1] < str(int(cutoff_time * 1000))]
-                for tid in old_tasks:
-                    del task_results[tid]
-                if old_tasks:
-                    logger.info(f"Cleaned up {len(old_tasks)} old tasks")
+            expired = expire_task_results()
+            if expired:
+                logger.info(f"Cleaned up {expired} old tasks")
 
             # Cleanup batch processors if available
             if batch_processing_available:
@@ -841,4 +1091,9 @@ cleanup_thread.start()
 
 if __name__ == '__main__':
     logger.info(f"Starting DocTags server on {HOST}:{PORT}")
-    app.run(debug=True, host=HOST, port=PORT)
\ No newline at end of file
+    if DEBUG or serve is None:
+        if serve is None and not DEBUG:
+            logger.warning("waitress is not installed, using the Flask development server")
+        app.run(debug=DEBUG, host=HOST, port=PORT, threaded=True)
+    else:
+        serve(app, host=HOST, port=PORT, threads=SERVER_THREADS)
\ No newline at end of file
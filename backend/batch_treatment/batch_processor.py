@@ -12,18 +12,38 @@ import queue
 import logging
 from pathlib import Path
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import shutil
 import zipfile
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-from backend.utils import ensure_results_folder, run_command_with_timeout, format_duration
-from backend.config import BATCH_WORKERS, PROCESSING_TIMEOUT
+from backend.utils import ensure_results_folder, format_duration, load_pdf_page
+from backend.config import BATCH_WORKERS, DEFAULT_DPI
+from backend.page_treatment import analyzer, visualizer, picture_extractor
 
 logger = logging.getLogger(__name__)
 
+# Static <style> block of the batch report, built once instead of per report
+REPORT_STYLE = """    <style>
+        body { font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }
+        .container { max-width: 1200px; margin: 0 auto; background: white; 
+                     padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+        h1 { color: #2c3e50; }
+        .stats { display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); 
+                  gap: 20px; margin: 30px 0; }
+        .stat-box { background: #ecf0f1; padding: 20px; border-radius: 8px; text-align: center; }
+        .stat-value { font-size: 2.5em; font-weight: bold; color: #2c3e50; }
+        .success { color: #27ae60; }
+        .error { color: #e74c3c; }
+        table { width: 100%; border-collapse: collapse; margin: 20px 0; }
+        th, td { padding: 12px; text-align: left; border-bottom: 1px solid #ecf0f1; }
+        th { background: #34495e; color: white; }
+    </style>
+"""
+
 
 class BatchProcessor:
     def __init__(self, batch_id, pdf_file, start_page, end_page, options):
@@ -60,15 +80,20 @@ class BatchProcessor:
 
         # Threading
         self.lock = threading.Lock()
+        # Signalled on every state change so streaming clients need not poll
+        self.state_changed = threading.Condition(self.lock)
+        self.version = 0
         self.pause_event = threading.Event()
         self.pause_event.set()  # Start unpaused
 
         # Create batch results directory
-        self.results_dir = ensure_results_folder() / f"batch_{batch_id}"
+        self.web_results_dir = ensure_results_folder()
+        self.results_dir = self.web_results_dir / f"batch_{batch_id}"
         self.results_dir.mkdir(parents=True, exist_ok=True)
 
-        # Log file
+        # Log file, kept open and line-buffered instead of reopened per message
         self.log_file = self.results_dir / "batch_processing.log"
+        self.log_handle = open(self.log_file, 'a', buffering=1)
 
     def log_message(self, message, level='info'):
         """Add a log message to the state"""
@@ -84,22 +109,41 @@ class BatchProcessor:
             # Keep only last 100 log entries
             if len(self.state['logs']) > 100:
                 self.state['logs'] = self.state['logs'][-100:]
-
-        # Write to log file
-        with open(self.log_file, 'a') as f:
-            f.write(f"[{timestamp}] [{level.upper()}] {message}\n")
+            self._notify_change()
+
+            # Write to log file; under the lock so lines from workers never interleave.
+            # The handle is closed once run() ends; later lines reopen the file.
+            line = f"[{timestamp}] [{level.upper()}] {message}\n"
+            if self.log_handle.closed:
+                with open(self.log_file, 'a') as f:
+                    f.write(line)
+            else:
+                self.log_handle.write(line)
 
         logger.info(f"[{level}] {message}")
 
+    def _notify_change(self):
+        """Bump the state version and wake streaming clients; caller holds the lock"""
+        self.version += 1
+        self.state_changed.notify_all()
+
+    def wait_for_update(self, last_version, timeout):
+        """Block until the state version moves past last_version or timeout; return it"""
+        with self.state_changed:
+            self.state_changed.wait_for(lambda: self.version != last_version, timeout)
+            return self.version
+
     def update_page_status(self, page_num, status):
         """Update the status of a specific page"""
         with self.lock:
             self.state['page_statuses'][str(page_num)] = status
+            self._notify_change()
 
     def update_stage_progress(self, stage, increment=1):
         """Update progress for a specific stage"""
         with self.lock:
             self.state['stages'][stage]['completed'] += increment
+            self._notify_change()
 
     def process_page(self, page_num):
         """Process a single page through all stages"""
@@ -107,33 +151,43 @@ class BatchProcessor:
             # Check if paused or cancelled
             self.pause_event.wait()
             if self.state['cancelled']:
+                self.update_page_status(page_num, 'cancelled')
                 return False
 
             self.log_message(f"Starting processing for page {page_num}")
             self.update_page_status(page_num, 'processing')
 
+            # Render the page once; every stage works from this image
+            page_image = load_pdf_page(self.pdf_file, page_num, DEFAULT_DPI)
+
             # Stage 1: Analysis
-            if not self.run_analyzer(page_num):
+            if not self.run_analyzer(page_num, page_image):
+                if self.state['cancelled']:
+                    self.update_page_status(page_num, 'cancelled')
+                    return False
                 raise Exception("Analyzer failed")
             self.update_stage_progress('analysis')
 
             # Check pause/cancel
             self.pause_event.wait()
             if self.state['cancelled']:
+                self.update_page_status(page_num, 'cancelled')
                 return False
 
             # Stage 2: Visualization
-            if not self.run_visualizer(page_num):
+            # The visualizer draws on its image, so it gets a copy
+            if not self.run_visualizer(page_num, page_image.copy()):
                 raise Exception("Visualizer failed")
             self.update_stage_progress('visualization')
 
             # Check pause/cancel
             self.pause_event.wait()
             if self.state['cancelled']:
+                self.update_page_status(page_num, 'cancelled')
                 return False
 
             # Stage 3: Extraction
-            image_count = self.run_extractor(page_num)
+            image_count = self.run_extractor(page_num, page_image)
             self.update_stage_progress('extraction')
 
             # Update results
@@ -141,6 +195,7 @@ class BatchProcessor:
                 self.state['results']['successful'] += 1
                 self.state['results']['totalImages'] += image_count
                 self.state['processed'] += 1
+                self._notify_change()
 
             self.update_page_status(page_num, 'completed')
             self.log_message(f"Successfully processed page {page_num}", 'success')
@@ -155,140 +210,96 @@ class BatchProcessor:
                     'reason': str(e)
                 })
                 self.state['processed'] += 1
+                self._notify_change()
 
             self.update_page_status(page_num, 'failed')
             self.log_message(f"Failed to process page {page_num}: {str(e)}", 'error')
             return False
 
-    def run_analyzer(self, page_num):
+    def run_analyzer(self, page_num, page_image=None):
         """Run the analyzer for a specific page"""
         try:
-            # Use page-specific output to avoid conflicts
-            command = (f"python backend/page_treatment/analyzer.py "
-                       f"--image {self.pdf_file} --page {page_num} "
-                       f"--start-page {page_num} --end-page {page_num}")
+            # Write straight to the page-specific file in the batch directory,
+            # so parallel pages never share an output file
+            doctags_dst = self.results_dir / f"page_{page_num}.doctags.txt"
 
             self.log_message(f"Running analyzer for page {page_num}")
 
-            success, stdout, stderr = run_command_with_timeout(command, PROCESSING_TIMEOUT)
-
-            if not success:
-                raise Exception(f"Analyzer failed: {stderr}")
-
-            # The analyzer will create either output.doctags.txt or output_pageN.doctags.txt
-            # Check both locations
-            results_dir = ensure_results_folder()
-            possible_paths = [
-                results_dir / "output.doctags.txt",
-                results_dir / f"output_page{page_num}.doctags.txt"
-            ]
-
-            doctags_src = None
-            for path in possible_paths:
-                if path.exists():
-                    doctags_src = path
-                    break
-
-            if not doctags_src:
-                raise Exception("DocTags file not generated")
+            content = analyzer.run_analyzer(
+                self.pdf_file, page_num, doctags_dst,
+                should_stop=lambda: self.state['cancelled'], pil_image=page_image
+            ).strip()
 
-            # Copy to batch directory with page-specific name
-            doctags_dst = self.results_dir / f"page_{page_num}.doctags.txt"
-            shutil.copy2(doctags_src, doctags_dst)
-
-            # Verify the file has content
-            with open(doctags_dst, 'r') as f:
-                content = f.read().strip()
-                if not content or '<doctag>' not in content:
-                    raise Exception("DocTags file is empty or invalid")
+            # Verify the output has content
+            if not content or '<doctag>' not in content:
+                raise Exception("DocTags file is empty or invalid")
 
             self.log_message(f"DocTags saved for page {page_num}")
             return True
 
+        except analyzer.AnalysisCancelled:
+            self.log_message(f"Analysis of page {page_num} stopped by cancel", 'warning')
+            return False
+
         except Exception as e:
             self.log_message(f"Analyzer error for page {page_num}: {str(e)}", 'error')
             return False
 
-    def run_visualizer(self, page_num):
+    def run_visualizer(self, page_num, page_image=None):
         """Run the visualizer for a specific page"""
         try:
-            # Ensure correct doctags file is in place
-            doctags_path = ensure_results_folder() / "output.doctags.txt"
             page_doctags = self.results_dir / f"page_{page_num}.doctags.txt"
-
-            if page_doctags.exists():
-                shutil.copy2(page_doctags, doctags_path)
-
-            command = (f"python backend/page_treatment/visualizer.py "
-                       f"--doctags {doctags_path} --pdf {self.pdf_file} --page {page_num}")
-
-            if self.options.get('adjust', True):
-                command += " --adjust"
+            viz_dst = self.results_dir / f"visualization_page_{page_num}.png"
 
             self.log_message(f"Running visualizer for page {page_num}")
 
-            success, stdout, stderr = run_command_with_timeout(command, PROCESSING_TIMEOUT)
-
-            if not success:
-                raise Exception(f"Visualizer failed: {stderr}")
-
-            # Copy visualization to batch directory
-            viz_src = ensure_results_folder() / f"visualization_page_{page_num}.png"
-            viz_dst = self.results_dir / f"visualization_page_{page_num}.png"
-
-            if viz_src.exists():
-                shutil.copy2(viz_src, viz_dst)
-                self.log_message(f"Visualization saved for page {page_num}")
+            visualizer.process_page(self.pdf_file, page_num, page_doctags, viz_dst,
+                                    DEFAULT_DPI, self.options.get('adjust', True),
+                                    image=page_image)
 
+            self.log_message(f"Visualization saved for page {page_num}")
             return True
 
         except Exception as e:
             self.log_message(f"Visualizer error for page {page_num}: {str(e)}", 'error')
             return False
 
-    def run_extractor(self, page_num):
+    def run_extractor(self, page_num, page_image=None):
         """Run the picture extractor for a specific page"""
         try:
-            # Ensure correct doctags file is in place
-            doctags_path = ensure_results_folder() / "output.doctags.txt"
             page_doctags = self.results_dir / f"page_{page_num}.doctags.txt"
-
-            if page_doctags.exists():
-                shutil.copy2(page_doctags, doctags_path)
-
-            command = (f"python backend/page_treatment/picture_extractor.py "
-                       f"--doctags {doctags_path} --pdf {self.pdf_file} --page {page_num}")
-
-            if self.options.get('adjust', True):
-                command += " --adjust"
-
-            self.log_message(f"Running extractor for page {page_num}")
-
-            success, stdout, stderr = run_command_with_timeout(command, PROCESSING_TIMEOUT)
-
-            if not success:
-                self.log_message(f"Extractor warning for page {page_num}: {stderr}", 'warning')
-
-            # Count and copy extracted images
-            image_count = 0
-            pics_src = ensure_results_folder() / "pictures"
             pics_dst = self.results_dir / f"pictures_page_{page_num}"
 
-            if pics_src.exists():
-                # Copy to batch directory
-                if pics_dst.exists():
-                    shutil.rmtree(pics_dst)
-                shutil.copytree(pics_src, pics_dst)
-
-                # Also copy for web interface
-                pics_web = ensure_results_folder() / f"pictures_page_{page_num}"
-                if pics_web.exists():
-                    shutil.rmtree(pics_web)
-                shutil.copytree(pics_src, pics_web)
+            self.log_message(f"Running extractor for page {page_num}")
 
-                # Count PNG files
-                image_count = len(list(pics_dst.glob("*.png")))
-                self.log_message(f"Extracted {image_count} images from page {page_num}")
+            # Start from an empty directory so stale pictures are not counted
+            if pics_dst.exists():
+                shutil.rmtree(pics_dst)
+
+            try:
+                saved_files = picture_extractor.run_extractor(
+                    page_doctags, self.pdf_file, page_num, pics_dst,
+                    adjust=self.options.get('adjust', True), page_image=page_image
+                )
+            except Exception as e:
+                self.log_message(f"Extractor warning for page {page_num}: {str(e)}", 'warning')
+                saved_files = []
+
+            # Also publish for web interface; hard links share the picture data
+            # instead of writing every file a second time
+            pics_web = self.web_results_dir / f"pictures_page_{page_num}"
+            if pics_web.exists():
+                shutil.rmtree(pics_web)
+            if pics_dst.exists():
+                try:
+                    shutil.copytree(pics_dst, pics_web, copy_function=os.link)
+                except (OSError, shutil.Error):
+                    # No hard links here (e.g. another filesystem): copy instead
+                    shutil.rmtree(pics_web, ignore_errors=True)
+                    shutil.copytree(pics_dst, pics_web)
+
+            image_count = len(saved_files)
+            self.log_message(f"Extracted {image_count} images from page {page_num}")
 
             return image_count
 
@@ -299,7 +310,8 @@ class BatchProcessor:
     def run(self):
         """Main batch processing loop"""
         try:
-            self.state['status'] = 'processing'
+            with self.lock:
+                self.state['status'] = 'processing'
             self.log_message(f"Starting batch processing for {self.pdf_file} "
                              f"(pages {self.start_page}-{self.end_page})")
 
@@ -312,21 +324,26 @@ class BatchProcessor:
             # Process pages
             if max_workers > 1:
                 # Parallel processing
+                # Keep only a bounded window of pages submitted, so a cancel stops
+                # new work right away instead of draining the whole document
                 with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    pending_pages = iter(pages)
                     futures = {executor.submit(self.process_page, page): page
-                               for page in pages}
-
-                    for future in as_completed(futures):
-                        if self.state['cancelled']:
-                            executor.shutdown(wait=False)
-                            break
-
-                        page = futures[future]
-                        try:
-                            future.result()
-                        except Exception as e:
-                            self.log_message(f"Unexpected error processing page {page}: {str(e)}",
-                                             'error')
+                               for page in islice(pending_pages, max_workers * 2)}
+
+                    while futures:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            page = futures.pop(future)
+                            try:
+                                future.result()
+                            except Exception as e:
+                                self.log_message(f"Unexpected error processing page {page}: {str(e)}",
+                                                 'error')
+
+                            if not self.state['cancelled']:
+                                for next_page in islice(pending_pages, 1):
+                                    futures[executor.submit(self.process_page, next_page)] = next_page
             else:
                 # Sequential processing
                 for page in pages:
@@ -342,6 +359,7 @@ class BatchProcessor:
             with self.lock:
                 self.state['completed'] = True
                 self.state['status'] = 'cancelled' if self.state['cancelled'] else 'completed'
+                self._notify_change()
 
             duration = time.time() - self.state['start_time']
             self.log_message(f"Batch processing completed in {format_duration(duration)}",
@@ -352,6 +370,13 @@ class BatchProcessor:
             with self.lock:
                 self.state['completed'] = True
                 self.state['status'] = 'error'
+                self._notify_change()
+
+        finally:
+            release_active_batch(self.pdf_file, self.batch_id)
+            # Finished batches keep no file descriptor open until cleanup
+            with self.lock:
+                self.log_handle.close()
 
     def generate_report(self):
         """Generate HTML report of batch processing results"""
@@ -377,27 +402,12 @@ class BatchProcessor:
 
     def _create_report_html(self, duration, success_rate):
         """Create HTML content for the report"""
-        html = f"""<!DOCTYPE html>
+        parts = [f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
     <title>Batch Processing Report - {self.pdf_file}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 40px; background: #f5f5f5; }}
-        .container {{ max-width: 1200px; margin: 0 auto; background: white; 
-                     padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-        h1 {{ color: #2c3e50; }}
-        .stats {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); 
-                  gap: 20px; margin: 30px 0; }}
-        .stat-box {{ background: #ecf0f1; padding: 20px; border-radius: 8px; text-align: center; }}
-        .stat-value {{ font-size: 2.5em; font-weight: bold; color: #2c3e50; }}
-        .success {{ color: #27ae60; }}
-        .error {{ color: #e74c3c; }}
-        table {{ width: 100%; border-collapse: collapse; margin: 20px 0; }}
-        th, td {{ padding: 12px; text-align: left; border-bottom: 1px solid #ecf0f1; }}
-        th {{ background: #34495e; color: white; }}
-    </style>
-</head>
+{REPORT_STYLE}</head>
 <body>
     <div class="container">
         <h1>Batch Processing Report</h1>
@@ -429,42 +439,46 @@ class BatchProcessor:
                 <div>Success Rate</div>
             </div>
         </div>
-"""
+"""]
 
         # Add failed pages if any
         if self.state['results']['failedPages']:
-            html += """
+            parts.append("""
         <h2>Failed Pages</h2>
         <table>
             <tr><th>Page Number</th><th>Reason</th></tr>
-"""
-            for failed in self.state['results']['failedPages']:
-                html += f"<tr><td>{failed['pageNum']}</td><td>{failed['reason']}</td></tr>\n"
-            html += "</table>\n"
+""")
+            parts.extend(f"<tr><td>{failed['pageNum']}</td><td>{failed['reason']}</td></tr>\n"
+                         for failed in self.state['results']['failedPages'])
+            parts.append("</table>\n")
 
-        html += """
+        parts.append("""
     </div>
 </body>
 </html>
-"""
-        return html
+""")
+        return "".join(parts)
 
     def pause(self):
         """Pause the batch processing"""
         self.pause_event.clear()
-        self.state['paused'] = True
+        with self.lock:
+            self.state['paused'] = True
         self.log_message("Batch processing paused")
 
     def resume(self):
         """Resume the batch processing"""
         self.pause_event.set()
-        self.state['paused'] = False
+        with self.lock:
+            self.state['paused'] = False
         self.log_message("Batch processing resumed")
 
     def cancel(self):
         """Cancel the batch processing"""
-        self.state['cancelled'] = True
+        with self.lock:
+            self.state['cancelled'] = True
         self.pause_event.set()
+        release_active_batch(self.pdf_file, self.batch_id)
         self.log_message("Batch processing cancelled")
 
     def get_state(self):
@@ -472,6 +486,14 @@ class BatchProcessor:
         with self.lock:
             state = self.state.copy()
 
+            # Copy the nested containers as well: workers keep mutating them
+            # once the lock is released, while the caller serializes this snapshot
+            state['page_statuses'] = dict(state['page_statuses'])
+            state['stages'] = {name: dict(stage) for name, stage in state['stages'].items()}
+            state['results'] = dict(state['results'],
+                                    failedPages=list(state['results']['failedPages']))
+            state['logs'] = list(state['logs'])
+
             # Calculate ETA
             if state['processed'] > 0 and not state['completed']:
                 elapsed = time.time() - state['start_time']
@@ -505,9 +527,25 @@ class BatchProcessor:
 
 # Global batch processors storage
 batch_processors = {}
+# PDF path -> id of the batch still running on it, so lookups need not scan
+# every batch ever started
+active_batches = {}
 batch_lock = threading.Lock()
 
 
+def find_active_batch(pdf_file):
+    """Return the id of the batch still running on a PDF, or None"""
+    with batch_lock:
+        return active_batches.get(pdf_file)
+
+
+def release_active_batch(pdf_file, batch_id):
+    """Forget a batch as the running one for its PDF"""
+    with batch_lock:
+        if active_batches.get(pdf_file) == batch_id:
+            del active_batches[pdf_file]
+
+
 def start_batch_processing(batch_id, pdf_file, start_page, end_page, options):
     """Start a new batch processing job"""
     try:
@@ -515,6 +553,7 @@ def start_batch_processing(batch_id, pdf_file, start_page, end_page, options):
 
         with batch_lock:
             batch_processors[batch_id] = processor
+            active_batches[pdf_file] = batch_id
 
         # Start processing in a separate thread
         thread = threading.Thread(target=processor.run)
@@ -548,5 +587,5 @@ def cleanup_old_batches(max_age_hours=24):
                     to_remove.append(batch_id)
 
         for batch_id in to_remove:
-            del batch_processors[batch_id]
+            batch_processors.pop(batch_id).log_handle.close()
             logger.info(f"Cleaned up old batch processor: {batch_id}")
\ No newline at end of file
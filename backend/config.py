@@ -15,15 +15,31 @@ DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
 HOST = '127.0.0.1'
 PORT = 5000
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB
+SERVER_THREADS = 16  # Request threads of the production (waitress) server
+# Each open event stream (/task-events, /batch-events) holds one server thread
+# until its task or batch ends; past this many, streams get a 503 and clients
+# poll instead, so the other threads stay free for ordinary requests
+MAX_EVENT_STREAMS = SERVER_THREADS // 2
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'False').lower() == 'true'
+STATIC_MAX_AGE = 0 if DEBUG else 86400  # Seconds browsers may reuse static assets unchecked
+PREVIEW_MAX_AGE = 3600  # Seconds browsers may reuse a page preview unchecked
 
 # Processing settings
 DEFAULT_DPI = 200
 PREVIEW_DPI = 150
+PREVIEW_MAX_WIDTH = 1200  # Pixel width previews are rasterized to at most
+PREVIEW_CACHE_MAX_BYTES = 500 * 1024 * 1024  # Rendered previews kept under results/previews
 DEFAULT_GRID_SIZE = 500
 MAX_IMAGE_WIDTH = 1200
+PICTURE_FORMAT = 'jpeg'  # 'jpeg' or 'png' for extracted pictures
+JPEG_QUALITY = 85
+PNG_COMPRESS_LEVEL = 1  # Fast zlib level for full-page PNGs; 6 is PIL's slower default
 DEFAULT_PAGE = 1
 PROCESSING_TIMEOUT = 300  # 5 minutes
-BATCH_WORKERS = 4
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+TASK_WORKERS = int(os.environ.get('TASK_WORKERS', max(2, (os.cpu_count() or 2) // 2)))  # Web page-step pool
+RENDER_WORKERS = min(8, os.cpu_count() or 1)
+BATCH_EVENT_HEARTBEAT = 15  # Seconds between keep-alive comments on idle event streams
 
 # File settings
 ALLOWED_EXTENSIONS = {'pdf'}
@@ -34,10 +50,14 @@ TEMP_DIR = 'temp_uploads'
 # Cleanup settings
 CLEANUP_AGE_HOURS = 24
 CLEANUP_INTERVAL = 3600  # 1 hour
+TASK_RESULTS_MAX = 512  # Task results kept for /task-status
+TASK_RESULTS_TTL = 3600  # Seconds a finished task result stays available
+TASK_OUTPUT_TAIL = 8192  # Characters of output/error kept per task result
 
 # Model settings
 MODEL_PATH = "ds4sd/SmolDocling-256M-preview-mlx-bf16"
 MAX_TOKENS = 4096
+MODEL_MAX_IMAGE_SIZE = None  # Longest side of page renders fed to the model; None reads it from the processor
 
 # Zone colors for visualization
 ZONE_COLORS = {
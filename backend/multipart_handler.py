@@ -21,6 +21,7 @@ class MultipartHandler:
 
     ALLOWED_EXTENSIONS = {'pdf'}
     MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+    COPY_BUFFER_SIZE = 1024 * 1024  # 1MB chunks instead of Werkzeug's 16KB default
     UPLOAD_FOLDER = 'uploads'
     TEMP_FOLDER = 'temp_uploads'
 
@@ -102,11 +103,10 @@ class MultipartHandler:
             save_folder = self.upload_folder if permanent else self.temp_folder
             filepath = save_folder / unique_filename
 
-            # Save file
-            file.save(str(filepath))
-
-            # Get file size
-            file_size = os.path.getsize(filepath)
+            # Stream the upload to disk in large chunks; the write offset is the size
+            with open(filepath, 'wb') as dst:
+                shutil.copyfileobj(file.stream, dst, length=self.COPY_BUFFER_SIZE)
+                file_size = dst.tell()
 
             logger.info(f"Saved file: {filepath} (size: {file_size} bytes)")
 
@@ -182,10 +182,11 @@ class MultipartHandler:
         """Get information about an uploaded file"""
         try:
             path = Path(filepath)
-            if not path.exists():
+            try:
+                stats = path.stat()
+            except FileNotFoundError:
                 return None
 
-            stats = path.stat()
             return {
                 'filepath': str(path),
                 'filename': path.name,
@@ -2,67 +2,107 @@
 # /// script
 # requires-python = ">=3.12"
 # dependencies = [
-#     "docling-core",
 #     "mlx-vlm",
 #     "pillow",
 #     "requests",
 #     "argparse",
 #     "pdf2image",
+#     "pymupdf",
 # ]
 # ///
 
 import argparse
-import os
-import tempfile
 import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse
 import requests
 from PIL import Image
 from pdf2image import convert_from_bytes
-from docling_core.types.doc import ImageRefMode
-from docling_core.types.doc.document import DocTagsDocument, DoclingDocument
 
 # Add parent directory to path for imports
 import sys
 sys.path.append(str(Path(__file__).parent.parent.parent))
 
-from backend.utils import ensure_results_folder, load_pdf_page, get_project_root
-from backend.config import MODEL_PATH, MAX_TOKENS, DEFAULT_DPI
+from backend.utils import (ensure_results_folder, load_pdf_page, get_project_root,
+                           render_pdf_page, fitz, RESULTS_DIR_NAME)
+from backend.config import (MODEL_PATH, MAX_TOKENS, DEFAULT_DPI, RENDER_WORKERS,
+                            MODEL_MAX_IMAGE_SIZE)
+
+# mlx-vlm only runs on Apple silicon; import it up front so the model load and the
+# first page do not pay for it, but keep the module importable elsewhere
+try:
+    from mlx_vlm import load
+    from mlx_vlm.utils import load_config, stream_generate
+    from mlx_vlm.prompt_utils import apply_chat_template
+except ImportError:
+    load = load_config = stream_generate = apply_chat_template = None
+
+# Marker that ends the model's DocTags output
+END_TAG = "</doctag>"
+DEFAULT_PROMPT = "Convert this page to docling."
+
+class AnalysisCancelled(Exception):
+    """Raised when a caller's should_stop callback asks generation to stop."""
+
+# Model, processor and config shared by every in-process caller
+_model_cache = None
+_model_lock = threading.Lock()
+
+# Chat-templated prompts for the cached model, keyed by prompt text
+_prompt_cache = {}
+# The MLX model runs one generation at a time
+_generate_lock = threading.Lock()
 
 def parse_arguments():
     """Parse command line arguments."""
-    results_dir = ensure_results_folder()
-
     parser = argparse.ArgumentParser(description='Convert an image or PDF to docling format')
     parser.add_argument('--image', '-i', type=str, required=True,
                         help='Path to local image file, PDF file, or URL')
-    parser.add_argument('--prompt', '-p', type=str, default="Convert this page to docling.",
+    parser.add_argument('--prompt', '-p', type=str, default=DEFAULT_PROMPT,
                         help='Prompt for the model')
-    parser.add_argument('--output', '-o', type=str, default=str(results_dir / "output.html"),
+    parser.add_argument('--output', '-o', type=str, default=str(get_project_root() / RESULTS_DIR_NAME / "output.html"),
                         help='Output file path')
     parser.add_argument('--page', type=int, default=1,
                         help='Page number to process for PDF files (starts at 1)')
     parser.add_argument('--dpi', type=int, default=DEFAULT_DPI,
-                        help='DPI for PDF rendering')
+                        help='Maximum DPI for PDF rendering (pages are also capped by --max-image-size)')
+    parser.add_argument('--max-image-size', type=int, default=MODEL_MAX_IMAGE_SIZE,
+                        help='Cap on the longest side of rendered pages in pixels. Defaults to the size '
+                             'the model processor resizes to, since larger renders only cost time; '
+                             '0 disables the cap')
     parser.add_argument('--start-page', type=int, default=1,
                         help='Start processing PDF from this page number')
     parser.add_argument('--end-page', type=int, default=None,
                         help='Stop processing PDF at this page number')
     return parser.parse_args()
 
-def load_image(image_path, page_num=1, dpi=DEFAULT_DPI):
-    """Load image from URL, local image file, or PDF."""
+def download_pdf(response, chunk_size=1 << 20):
+    """Read a streamed PDF response into a single bytearray, chunk by chunk."""
+    pdf_data = bytearray()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        pdf_data += chunk
+    return pdf_data
+
+def open_document(image_path):
+    """
+    Open an image, PDF file, or URL once so pages can be rendered repeatedly.
+
+    Returns an open PyMuPDF document for PDFs (raw bytes or the file path when
+    PyMuPDF is not installed), or a PIL image for plain image inputs.
+    """
     if urlparse(image_path).scheme in ['http', 'https']:
         response = requests.get(image_path, stream=True, timeout=10)
         response.raise_for_status()
 
         if image_path.lower().endswith('.pdf') or response.headers.get('Content-Type') == 'application/pdf':
-            print(f"Converting PDF from URL (page {page_num})...")
-            pdf_images = convert_from_bytes(response.content, dpi=dpi, first_page=page_num, last_page=page_num)
-            if not pdf_images:
-                raise Exception(f"Could not extract page {page_num} from PDF")
-            return pdf_images[0]
+            print("Downloading PDF from URL...")
+            pdf_data = download_pdf(response)
+            if fitz is not None:
+                return fitz.open(stream=pdf_data, filetype='pdf')
+            return bytes(pdf_data)
         else:
             return Image.open(response.raw)
     else:
@@ -71,95 +111,277 @@ def load_image(image_path, page_num=1, dpi=DEFAULT_DPI):
             raise FileNotFoundError(f"File not found: {image_path}")
 
         if image_path.suffix.lower() == '.pdf':
-            return load_pdf_page(str(image_path), page_num, dpi)
+            if fitz is not None:
+                return fitz.open(str(image_path))
+            return str(image_path)
         else:
             return Image.open(image_path)
 
-def process_page(model, processor, config, args, pil_image, page_num=1):
-    """Process a single page from a PDF or image file."""
-    from mlx_vlm.prompt_utils import apply_chat_template
-    from mlx_vlm.utils import stream_generate
+def render_page(doc, page_num=1, dpi=DEFAULT_DPI, max_size=None):
+    """
+    Render one page of a document returned by open_document as a PIL image.
 
-    results_dir = ensure_results_folder()
+    With max_size, the longest side of PDF renders is capped at max_size pixels.
+    """
+    if isinstance(doc, Image.Image):
+        return doc
 
-    # For web interface, always use output.doctags.txt
-    # For command line with specific pages, use page-specific names
-    if args.start_page == args.end_page and args.start_page == page_num:
-        # Single page processing
-        output_path = results_dir / "output.html"
-        doctags_path = results_dir / "output.doctags.txt"
+    if fitz is not None and isinstance(doc, fitz.Document):
+        return render_pdf_page(doc, page_num, dpi, max_size)
+
+    if isinstance(doc, bytes):
+        print(f"Converting PDF from URL (page {page_num})...")
+        pdf_images = convert_from_bytes(doc, dpi=dpi, first_page=page_num, last_page=page_num)
+        if not pdf_images:
+            raise Exception(f"Could not extract page {page_num} from PDF")
+        pil_image = pdf_images[0]
     else:
-        # Multi-page processing
-        output_path = results_dir / f"output_page{page_num}.html"
-        doctags_path = results_dir / f"output_page{page_num}.doctags.txt"
+        pil_image = load_pdf_page(doc, page_num, dpi)
 
-    print(f"Processing page {page_num}")
+    # pdf2image cannot size by page dimensions up front, so shrink afterwards
+    if max_size:
+        pil_image.thumbnail((max_size, max_size))
+    return pil_image
+
+def load_image(image_path, page_num=1, dpi=DEFAULT_DPI, max_size=None):
+    """Load image from URL, local image file, or PDF."""
+    doc = open_document(image_path)
+    try:
+        return render_page(doc, page_num, dpi, max_size)
+    finally:
+        if fitz is not None and isinstance(doc, fitz.Document):
+            doc.close()
+
+def iter_rendered_pages(doc, page_numbers, dpi=DEFAULT_DPI, max_size=None,
+                        workers=RENDER_WORKERS):
+    """
+    Yield (page_num, pil_image) in order while a thread pool renders ahead.
 
-    # Save image temporarily
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_img_file:
-        temp_img_path = temp_img_file.name
-        pil_image.save(temp_img_path, format='PNG')
+    At most `workers + 1` pages are in flight, so rendering upcoming pages
+    overlaps with model inference on the current one without unbounded memory.
+    """
+    worker_docs = []
+    if fitz is not None and isinstance(doc, fitz.Document):
+        # An open PyMuPDF document is not safe to share between threads, so each
+        # worker opens its own copy of the file (or of the downloaded bytes)
+        source = doc.name or doc.tobytes()
+        local = threading.local()
+        docs_lock = threading.Lock()
 
+        def render_in_worker(_doc, page_num, dpi, max_size):
+            if not hasattr(local, 'doc'):
+                if isinstance(source, bytes):
+                    local.doc = fitz.open(stream=source, filetype='pdf')
+                else:
+                    local.doc = fitz.open(source)
+                with docs_lock:
+                    worker_docs.append(local.doc)
+            return render_page(local.doc, page_num, dpi, max_size)
+        render = render_in_worker
+    else:
+        # pdf2image sources (path or bytes) render in separate poppler processes
+        render = render_page
+
+    pending = deque()
     try:
-        # Apply chat template and generate
-        formatted_prompt = apply_chat_template(processor, config, args.prompt, num_images=1)
-
-        print(f"Generating DocTags for page {page_num}: \n\n")
-        output = ""
-        for token in stream_generate(
-                model, processor, formatted_prompt, [temp_img_path], max_tokens=MAX_TOKENS, verbose=False
-        ):
-            output += token.text
-            print(token.text, end="")
-            if "</doctag>" in token.text:
-                break
-        print("\n\n")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for page_num in page_numbers:
+                pending.append((page_num, executor.submit(render, doc, page_num, dpi, max_size)))
+                if len(pending) > workers + 1:
+                    ready_num, future = pending.popleft()
+                    yield ready_num, future.result()
 
+            while pending:
+                ready_num, future = pending.popleft()
+                yield ready_num, future.result()
     finally:
-        # Clean up temporary file
-        if os.path.exists(temp_img_path):
-            os.unlink(temp_img_path)
+        for worker_doc in worker_docs:
+            worker_doc.close()
+
+def get_output_paths(args, page_num):
+    """Return (output_path, doctags_path) for a page."""
+    results_dir = args.results_dir
+
+    # For web interface, always use output.doctags.txt
+    # For command line with specific pages, use page-specific names
+    if args.start_page == args.end_page and args.start_page == page_num:
+        # Single page processing
+        return results_dir / "output.html", results_dir / "output.doctags.txt"
+
+    # Multi-page processing
+    return (results_dir / f"output_page{page_num}.html",
+            results_dir / f"output_page{page_num}.doctags.txt")
+
+def save_doctags(args, page_num, output):
+    """Write the raw DocTags of a page and return the page's output path."""
+    output_path, doctags_path = get_output_paths(args, page_num)
 
-    # Save DocTags output
     with open(doctags_path, 'w', encoding='utf-8') as f:
         f.write(output)
     print(f"Raw DocTags saved to: {doctags_path}")
 
     return output_path
 
+def generate_doctags(model, processor, formatted_prompt, pil_image, page_num=1,
+                     should_stop=None):
+    """
+    Stream DocTags for one page image from the model.
+
+    should_stop is checked after every token; when it returns True the
+    generation is abandoned with AnalysisCancelled.
+    """
+    # The PIL image is handed to mlx-vlm directly, without a PNG round-trip
+    # through a temporary file
+    print(f"Generating DocTags for page {page_num}: \n\n")
+    chunks = []
+    tail = ""
+    for token in stream_generate(
+            model, processor, formatted_prompt, [pil_image], max_tokens=MAX_TOKENS, verbose=False
+    ):
+        if should_stop is not None and should_stop():
+            raise AnalysisCancelled(f"Analysis of page {page_num} cancelled")
+        chunks.append(token.text)
+        sys.stdout.write(token.text)
+        # Only look at the last few characters, in case the end tag spans tokens
+        tail = (tail + token.text)[-len(END_TAG) - 8:]
+        if END_TAG in tail:
+            break
+    sys.stdout.write("\n\n\n")
+    sys.stdout.flush()
+    return "".join(chunks)
+
+def format_prompt(processor, config, prompt):
+    """Apply the chat template for a one-image prompt."""
+    return apply_chat_template(processor, config, prompt, num_images=1)
+
+def process_page(model, processor, config, args, pil_image, page_num=1, formatted_prompt=None):
+    """
+    Process a single page from a PDF or image file.
+
+    Pass formatted_prompt to reuse a chat template already applied for
+    earlier pages of the same document.
+    """
+    print(f"Processing page {page_num}")
+
+    if formatted_prompt is None:
+        formatted_prompt = format_prompt(processor, config, args.prompt)
+    output = generate_doctags(model, processor, formatted_prompt, pil_image, page_num)
+
+    return save_doctags(args, page_num, output)
+
+def get_model():
+    """Load the model, processor and config once per process and return them."""
+    global _model_cache
+    with _model_lock:
+        if _model_cache is None:
+            if load is None:
+                raise RuntimeError("mlx-vlm is not installed")
+            model, processor = load(MODEL_PATH)
+            config = load_config(MODEL_PATH)
+            _model_cache = (model, processor, config)
+    return _model_cache
+
+def get_model_image_size():
+    """Longest image side the model's processor resizes to, or None if it does not say."""
+    model, processor, config = get_model()
+    size = getattr(getattr(processor, 'image_processor', None), 'size', None)
+    if isinstance(size, dict):
+        return size.get('longest_edge')
+    return None
+
+def get_formatted_prompt(prompt=DEFAULT_PROMPT):
+    """Apply the chat template for prompt once per process and reuse it."""
+    model, processor, config = get_model()
+    with _model_lock:
+        if prompt not in _prompt_cache:
+            _prompt_cache[prompt] = format_prompt(processor, config, prompt)
+        return _prompt_cache[prompt]
+
+def run_analyzer(pdf_path, page_num, output_path, dpi=DEFAULT_DPI, prompt=DEFAULT_PROMPT,
+                 max_size=MODEL_MAX_IMAGE_SIZE, should_stop=None, pil_image=None):
+    """
+    Analyze one page in the calling process and write its DocTags to output_path.
+
+    The model is loaded on first use and kept for later calls, so batch workers
+    pay the import and load cost once instead of once per page. Rendering runs
+    concurrently across threads; generation itself is serialized.
+
+    should_stop lets the caller cancel: it is checked before waiting pages
+    start generating and after every generated token. Pass pil_image to reuse
+    a page the caller has already rendered; it is downscaled, never modified.
+    max_size defaults to the processor's own resize target (0 disables it).
+
+    Returns the DocTags text.
+    """
+    model, processor, config = get_model()
+    if max_size is None:
+        max_size = get_model_image_size()
+    if pil_image is None:
+        pil_image = load_image(pdf_path, page_num, dpi, max_size)
+    elif max_size and max(pil_image.size) > max_size:
+        pil_image = pil_image.copy()
+        pil_image.thumbnail((max_size, max_size))
+    formatted_prompt = get_formatted_prompt(prompt)
+
+    with _generate_lock:
+        if should_stop is not None and should_stop():
+            raise AnalysisCancelled(f"Analysis of page {page_num} cancelled")
+        output = generate_doctags(model, processor, formatted_prompt, pil_image, page_num,
+                                  should_stop)
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(output)
+    return output
+
 def main():
     args = parse_arguments()
 
+    # Create the results folder once and reuse it for every page
+    args.results_dir = ensure_results_folder()
+
     # Load the model
     print("Loading model...")
     try:
-        from mlx_vlm import load
-        from mlx_vlm.utils import load_config
-
-        model, processor = load(MODEL_PATH)
-        config = load_config(MODEL_PATH)
+        model, processor, config = get_model()
     except Exception as e:
         print(f"Error loading model: {e}")
         return
 
+    # Render no larger than the processor will resize pages to
+    if args.max_image_size is None:
+        args.max_image_size = get_model_image_size()
+
+    # The prompt is the same for every page, so template it once
+    formatted_prompt = get_formatted_prompt(args.prompt)
+
     # Process the image/PDF
+    doc = None
     try:
         # Handle single page or range
         start_page = args.start_page
         end_page = args.end_page or args.page
 
-        for page_num in range(start_page, end_page + 1):
-            print(f"\nProcessing page {page_num}...")
+        # Open (or download) the document once for all pages
+        doc = open_document(args.image)
 
-            pil_image = load_image(args.image, page_num=page_num, dpi=args.dpi)
+        # Render upcoming pages in the background while the model runs
+        pages = iter_rendered_pages(doc, range(start_page, end_page + 1), dpi=args.dpi,
+                                    max_size=args.max_image_size)
+        for page_num, pil_image in pages:
+            print(f"\nProcessing page {page_num}...")
             print(f"Page {page_num} loaded: {pil_image.size}")
 
-            process_page(model, processor, config, args, pil_image, page_num)
+            process_page(model, processor, config, args, pil_image, page_num,
+                         formatted_prompt=formatted_prompt)
 
     except Exception as e:
         print(f"Error processing: {e}")
         import traceback
         traceback.print_exc()
 
+    finally:
+        if fitz is not None and isinstance(doc, fitz.Document):
+            doc.close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
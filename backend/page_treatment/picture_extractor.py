@@ -4,7 +4,6 @@ DocTags Picture Extractor - Extract <picture> elements from DocTags.
 """
 
 import argparse
-import os
 import re
 from pathlib import Path
 from PIL import Image
@@ -15,15 +14,51 @@ sys.path.append(str(Path(__file__).parent.parent.parent))
 
 from backend.utils import (ensure_results_folder, load_pdf_page,
                            normalize_coordinates, auto_adjust_coordinates,
-                           validate_coordinates)
-from backend.config import DEFAULT_DPI, MAX_IMAGE_WIDTH, DEFAULT_GRID_SIZE
-
-# Regular expression to extract picture location data
-PICTURE_PATTERN = r'<picture>.*?<loc_(\d+)><loc_(\d+)><loc_(\d+)><loc_(\d+)>(.*?)</picture>'
+                           validate_coordinates, parse_doctag_zones,
+                           get_project_root, RESULTS_DIR_NAME)
+from backend.config import (DEFAULT_DPI, MAX_IMAGE_WIDTH, DEFAULT_GRID_SIZE,
+                            PICTURE_FORMAT, JPEG_QUALITY, PNG_COMPRESS_LEVEL)
+
+# Pre-compiled patterns, built once at import time instead of per call
+UNSAFE_CHARS_RE = re.compile(r'[^\w\s-]')
+
+# Static <style> block of the gallery index, built once instead of per page
+GALLERY_STYLE = """    <style>
+        body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }
+        h1 { color: #333; }
+        .gallery { 
+            display: grid; 
+            grid-template-columns: repeat(auto-fill, minmax(300px, 1fr));
+            gap: 20px;
+            margin-top: 20px;
+        }
+        .picture-card { 
+            background-color: white;
+            border-radius: 5px;
+            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+            overflow: hidden;
+        }
+        .picture-card img { 
+            width: 100%;
+            height: auto;
+            display: block;
+        }
+        .picture-info { 
+            padding: 15px;
+        }
+        .no-pictures { 
+            background-color: white;
+            padding: 20px;
+            border-radius: 5px;
+            text-align: center;
+            color: #777;
+        }
+    </style>
+"""
 
 def parse_arguments():
     """Parse command line arguments."""
-    results_dir = ensure_results_folder()
+    results_dir = get_project_root() / RESULTS_DIR_NAME
 
     parser = argparse.ArgumentParser(description='Extract pictures from DocTags format')
     parser.add_argument('--doctags', '-d', type=str, required=True,
@@ -42,38 +77,50 @@ def parse_arguments():
                         help='Try to automatically adjust scaling')
     parser.add_argument('--margin', type=int, default=0,
                         help='Add margin around extracted pictures in pixels')
+    parser.add_argument('--image-format', type=str, choices=['jpeg', 'png'], default=PICTURE_FORMAT,
+                        help='Format of extracted pictures (jpeg is much smaller and faster; '
+                             'png is lossless)')
+    parser.add_argument('--no-html', action='store_true',
+                        help='Do not write the index.html gallery')
+    parser.add_argument('--no-captions', action='store_true',
+                        help='Do not write a caption .txt file next to each picture')
     return parser.parse_args()
 
 def extract_pictures_from_doctags(doctags_path):
     """Parse DocTags file and extract picture elements with their coordinates."""
-    if not os.path.exists(doctags_path):
+    try:
+        with open(doctags_path, 'r', encoding='utf-8') as f:
+            doctags_content = f.read()
+    except FileNotFoundError:
         raise FileNotFoundError(f"DocTags file not found: {doctags_path}")
 
-    with open(doctags_path, 'r', encoding='utf-8') as f:
-        doctags_content = f.read()
-
+    # Reuse the shared single-pass DocTags parser and keep only pictures
+    zones = parse_doctag_zones(doctags_content)
     pictures = []
-    picture_matches = re.finditer(PICTURE_PATTERN, doctags_content, re.DOTALL)
 
-    for i, match in enumerate(picture_matches):
-        x1, y1, x2, y2, caption = match.groups()
-
-        # Clean caption
-        clean_caption = re.sub(r'<loc_\d+>', '', caption).strip()
+    for zone in zones:
+        if zone['type'] != 'picture':
+            continue
 
         pictures.append({
-            'id': i + 1,
-            'x1': int(x1), 'y1': int(y1),
-            'x2': int(x2), 'y2': int(y2),
-            'caption': clean_caption
+            'id': len(pictures) + 1,
+            'x1': zone['x1'], 'y1': zone['y1'],
+            'x2': zone['x2'], 'y2': zone['y2'],
+            'caption': zone['content']
         })
 
     return pictures
 
-def extract_and_save_pictures(image, pictures, output_dir, max_width, margin):
-    """Extract picture regions from the image and save them as separate files."""
-    output_path = ensure_results_folder(output_dir)
+def extract_and_save_pictures(image, pictures, output_dir, max_width, margin,
+                              image_format=PICTURE_FORMAT, save_captions=True):
+    """
+    Extract picture regions from the image and save them as separate files.
+
+    output_dir must already exist; run_extractor creates it once per page.
+    """
+    output_path = Path(output_dir)
     saved_files = []
+    extension = 'jpg' if image_format == 'jpeg' else 'png'
 
     for picture in pictures:
         try:
@@ -95,21 +142,25 @@ def extract_and_save_pictures(image, pictures, output_dir, max_width, margin):
             if cropped_img.width > max_width:
                 ratio = max_width / cropped_img.width
                 new_height = int(cropped_img.height * ratio)
-                cropped_img = cropped_img.resize((max_width, new_height), Image.LANCZOS)
+                cropped_img = cropped_img.resize((max_width, new_height), Image.BILINEAR)
 
             # Generate filename
             if picture['caption']:
-                safe_caption = re.sub(r'[^\w\s-]', '', picture['caption'])[:30].strip().replace(' ', '_').lower()
-                filename = f"picture_{picture['id']}_{safe_caption}.png"
+                safe_caption = UNSAFE_CHARS_RE.sub('', picture['caption'])[:30].strip().replace(' ', '_').lower()
+                filename = f"picture_{picture['id']}_{safe_caption}.{extension}"
             else:
-                filename = f"picture_{picture['id']}.png"
+                filename = f"picture_{picture['id']}.{extension}"
 
             # Save the image
             output_file = output_path / filename
-            cropped_img.save(output_file, format="PNG")
+            if image_format == 'jpeg':
+                cropped_img.convert('RGB').save(output_file, format="JPEG", quality=JPEG_QUALITY,
+                                                optimize=True, progressive=True)
+            else:
+                cropped_img.save(output_file, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
 
             # Save caption if available
-            if picture['caption']:
+            if save_captions and picture['caption']:
                 caption_file = output_path / f"{output_file.stem}.txt"
                 with open(caption_file, 'w', encoding='utf-8') as f:
                     f.write(picture['caption'])
@@ -127,54 +178,23 @@ def create_html_index(pictures, saved_files, pdf_name, page_num, output_dir):
     output_path = Path(output_dir)
     index_file = output_path / "index.html"
 
-    html = f"""<!DOCTYPE html>
+    parts = [f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
     <title>Extracted Pictures from {pdf_name} - Page {page_num}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }}
-        h1 {{ color: #333; }}
-        .gallery {{ 
-            display: grid; 
-            grid-template-columns: repeat(auto-fill, minmax(300px, 1fr));
-            gap: 20px;
-            margin-top: 20px;
-        }}
-        .picture-card {{ 
-            background-color: white;
-            border-radius: 5px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            overflow: hidden;
-        }}
-        .picture-card img {{ 
-            width: 100%;
-            height: auto;
-            display: block;
-        }}
-        .picture-info {{ 
-            padding: 15px;
-        }}
-        .no-pictures {{ 
-            background-color: white;
-            padding: 20px;
-            border-radius: 5px;
-            text-align: center;
-            color: #777;
-        }}
-    </style>
-</head>
+{GALLERY_STYLE}</head>
 <body>
     <h1>Extracted Pictures from {pdf_name} - Page {page_num}</h1>
     <p>Total pictures found: {len(pictures)}</p>
-"""
+"""]
 
     if pictures:
-        html += '    <div class="gallery">\n'
+        parts.append('    <div class="gallery">\n')
 
         for picture, file_path in zip(pictures, saved_files):
             rel_path = file_path.name
-            html += f"""        <div class="picture-card">
+            parts.append(f"""        <div class="picture-card">
             <img src="{rel_path}" alt="Picture {picture['id']}">
             <div class="picture-info">
                 <h3>Picture {picture['id']}</h3>
@@ -182,65 +202,88 @@ def create_html_index(pictures, saved_files, pdf_name, page_num, output_dir):
                 <div class="picture-coords">Coordinates: ({picture['x1']},{picture['y1']})-({picture['x2']},{picture['y2']})</div>
             </div>
         </div>
-"""
+""")
 
-        html += '    </div>\n'
+        parts.append('    </div>\n')
     else:
-        html += '    <div class="no-pictures">\n        <h2>No pictures found on this page</h2>\n    </div>\n'
+        parts.append('    <div class="no-pictures">\n        <h2>No pictures found on this page</h2>\n    </div>\n')
 
-    html += '</body>\n</html>\n'
+    parts.append('</body>\n</html>\n')
 
     with open(index_file, 'w', encoding='utf-8') as f:
-        f.write(html)
+        f.write("".join(parts))
 
     print(f"Created index file: {index_file}")
     return index_file
 
+def run_extractor(doctags_path, pdf_path, page_num, output_dir, dpi=DEFAULT_DPI,
+                  max_width=MAX_IMAGE_WIDTH, adjust=False, margin=0,
+                  image_format=PICTURE_FORMAT, save_captions=True, write_html=True,
+                  page_image=None):
+    """
+    Extract the pictures of one page into output_dir and return the saved files.
+
+    This is the in-process entry point; main() wraps it for the command line.
+    Pass page_image to reuse an already rendered page instead of loading it.
+    """
+    output_dir = ensure_results_folder(output_dir)
+
+    # Extract pictures from DocTags
+    print(f"Extracting pictures from {doctags_path}...")
+    pictures = extract_pictures_from_doctags(doctags_path)
+
+    if not pictures:
+        print("No picture elements found in the DocTags file.")
+        return []
+
+    print(f"Found {len(pictures)} picture elements.")
+
+    # Load the image from PDF
+    if page_image is None:
+        page_image = load_pdf_page(pdf_path, page_num, dpi)
+    print(f"Loaded page {page_num} image: {page_image.size[0]}x{page_image.size[1]}")
+
+    # Adjust coordinates if needed
+    if adjust:
+        # Check if coordinates need normalization
+        max_x = max([p['x2'] for p in pictures])
+        max_y = max([p['y2'] for p in pictures])
+
+        if max_x <= DEFAULT_GRID_SIZE and max_y <= DEFAULT_GRID_SIZE:
+            print(f"Detected normalized coordinates (0-{DEFAULT_GRID_SIZE} grid)")
+            pictures = normalize_coordinates(pictures, page_image.width, page_image.height)
+        else:
+            pictures = auto_adjust_coordinates(pictures, page_image.width, page_image.height)
+
+    # Extract and save pictures
+    saved_files = extract_and_save_pictures(
+        page_image, pictures, output_dir,
+        max_width, margin, image_format,
+        save_captions=save_captions
+    )
+
+    # Create HTML index
+    if write_html:
+        pdf_name = Path(pdf_path).stem
+        create_html_index(pictures, saved_files, pdf_name, page_num, output_dir)
+
+    return saved_files
+
 def main():
     args = parse_arguments()
-    output_dir = ensure_results_folder(args.output)
 
     try:
-        # Extract pictures from DocTags
-        print(f"Extracting pictures from {args.doctags}...")
-        pictures = extract_pictures_from_doctags(args.doctags)
-
-        if not pictures:
-            print("No picture elements found in the DocTags file.")
-            return
-
-        print(f"Found {len(pictures)} picture elements.")
-
-        # Load the image from PDF
-        page_image = load_pdf_page(args.pdf, args.page, args.dpi)
-        print(f"Loaded page {args.page} image: {page_image.size[0]}x{page_image.size[1]}")
-
-        # Adjust coordinates if needed
-        if args.adjust:
-            # Check if coordinates need normalization
-            max_x = max([p['x2'] for p in pictures])
-            max_y = max([p['y2'] for p in pictures])
-
-            if max_x <= DEFAULT_GRID_SIZE and max_y <= DEFAULT_GRID_SIZE:
-                print(f"Detected normalized coordinates (0-{DEFAULT_GRID_SIZE} grid)")
-                pictures = normalize_coordinates(pictures, page_image.width, page_image.height)
-            else:
-                pictures = auto_adjust_coordinates(pictures, page_image.width, page_image.height)
-
-        # Extract and save pictures
-        saved_files = extract_and_save_pictures(
-            page_image, pictures, output_dir,
-            args.max_width, args.margin
+        run_extractor(
+            args.doctags, args.pdf, args.page, args.output,
+            dpi=args.dpi, max_width=args.max_width, adjust=args.adjust,
+            margin=args.margin, image_format=args.image_format,
+            save_captions=not args.no_captions, write_html=not args.no_html
         )
 
-        # Create HTML index
-        pdf_name = Path(args.pdf).stem
-        create_html_index(pictures, saved_files, pdf_name, args.page, output_dir)
-
     except Exception as e:
         print(f"Error: {e}")
         import traceback
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
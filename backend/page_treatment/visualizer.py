@@ -6,6 +6,8 @@ DocTags Zone Visualizer - Visualize zones identified in DocTags format.
 import argparse
 import os
 import re
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 
@@ -14,16 +16,16 @@ import sys
 sys.path.append(str(Path(__file__).parent.parent.parent))
 
 from backend.utils import (ensure_results_folder, load_pdf_page, count_pdf_pages,
-                           normalize_coordinates, auto_adjust_coordinates)
-from backend.config import ZONE_COLORS, DEFAULT_DPI, DEFAULT_GRID_SIZE
+                           normalize_coordinates, auto_adjust_coordinates,
+                           parse_doctag_zones)
+from backend.config import ZONE_COLORS, DEFAULT_DPI, DEFAULT_GRID_SIZE, PNG_COMPRESS_LEVEL
 
-# Regular expression to extract location data
-LOC_PATTERN = r'<loc_(\d+)><loc_(\d+)><loc_(\d+)><loc_(\d+)>'
+# Pre-compiled patterns, built once at import time instead of per call
+DOCTAG_RE = re.compile(r'<doctag>(.*?)</doctag>', re.DOTALL)
+TAG_RE = re.compile(r'<(/?)(\w+)>')
 
 def parse_arguments():
     """Parse command line arguments."""
-    results_dir = ensure_results_folder()
-
     parser = argparse.ArgumentParser(description='Visualize zones identified in DocTags format')
     parser.add_argument('--doctags', '-d', type=str, required=False,
                         help='Path to DocTags file (optional, will auto-detect if not provided)')
@@ -41,102 +43,44 @@ def parse_arguments():
 
 def parse_doctags(doctags_path):
     """Parse DocTags file and extract zones with their coordinates."""
-    if not os.path.exists(doctags_path):
+    try:
+        with open(doctags_path, 'r', encoding='utf-8') as f:
+            doctags_content = f.read()
+    except FileNotFoundError:
         raise FileNotFoundError(f"DocTags file not found: {doctags_path}")
 
-    with open(doctags_path, 'r', encoding='utf-8') as f:
-        doctags_content = f.read()
-
     # Check if file is empty or invalid
     if not doctags_content.strip():
         raise ValueError("DocTags file is empty")
 
     # Extract content between <doctag> tags
-    doctag_match = re.search(r'<doctag>(.*?)</doctag>', doctags_content, re.DOTALL)
+    doctag_match = DOCTAG_RE.search(doctags_content)
     if not doctag_match:
         raise ValueError("No <doctag> tags found in the file")
 
     doctag_content = doctag_match.group(1)
-    zones = []
-
-    # Define all possible tag types to look for
-    tag_types = [
-        'section_header_level_1', 'section_header_level_2', 'section_header_level_3',
-        'text', 'picture', 'table', 'page_header', 'page_footer',
-        'title', 'author', 'abstract', 'keywords', 'paragraph',
-        'list_item', 'code_block', 'footnote', 'caption'
-    ]
-
-    # Find all zones with location information using a more robust pattern
-    for tag_type in tag_types:
-        # Pattern to match the complete tag with location data
-        pattern = rf'<{tag_type}>.*?{LOC_PATTERN}.*?</{tag_type}>'
-        matches = re.finditer(pattern, doctag_content, re.DOTALL)
-
-        for match in matches:
-            full_match = match.group(0)
-            loc_match = re.search(LOC_PATTERN, full_match)
-
-            if loc_match:
-                x1, y1, x2, y2 = map(int, loc_match.groups())
-
-                # Extract text content (remove location tags)
-                content_start = full_match.find('>') + 1
-                content_end = full_match.rfind('</')
-                content = full_match[content_start:content_end]
-                content = re.sub(r'<loc_\d+>', '', content).strip()
-
-                zones.append({
-                    'type': tag_type,
-                    'x1': x1, 'y1': y1,
-                    'x2': x2, 'y2': y2,
-                    'content': content
-                })
-
-    # Also try a more general pattern for any tags we might have missed
-    general_pattern = r'<(\w+)>.*?' + LOC_PATTERN + r'.*?</\1>'
-    general_matches = re.finditer(general_pattern, doctag_content, re.DOTALL)
-
-    found_tags = set()
-    for zone in zones:
-        found_tags.add(f"{zone['type']}_{zone['x1']}_{zone['y1']}")
 
-    for match in general_matches:
-        tag_name = match.group(1)
-        if tag_name.startswith('loc_'):
-            continue
-
-        x1, y1, x2, y2 = map(int, match.groups()[1:5])
-        tag_key = f"{tag_name}_{x1}_{y1}"
-
-        # Avoid duplicates
-        if tag_key not in found_tags:
-            full_match = match.group(0)
-            content_start = full_match.find('>') + 1
-            content_end = full_match.rfind('</')
-            content = full_match[content_start:content_end]
-            content = re.sub(r'<loc_\d+>', '', content).strip()
-
-            zones.append({
-                'type': tag_name,
-                'x1': x1, 'y1': y1,
-                'x2': x2, 'y2': y2,
-                'content': content
-            })
-            found_tags.add(tag_key)
+    zones = parse_doctag_zones(doctag_content)
 
     # If no zones found, log the content for debugging
     if not zones:
         print(f"Warning: No zones with location data found in {doctags_path}")
         print(f"DocTags content preview: {doctag_content[:500]}...")
 
-        # Try to find any loc_ tags to debug
-        loc_tags = re.findall(r'<loc_\d+>', doctag_content)
-        if loc_tags:
-            print(f"Found {len(loc_tags)} location tags in the file")
+        # Count location and element tags in one tokenizer pass to debug
+        tag_counts = Counter(match.group(2) for match in TAG_RE.finditer(doctag_content)
+                             if not match.group(1))
+        loc_count = sum(count for tag, count in tag_counts.items() if tag.startswith('loc_'))
+        if loc_count:
+            print(f"Found {loc_count} location tags in the file")
         else:
             print("No location tags found in the file at all")
 
+        element_counts = {tag: count for tag, count in tag_counts.items()
+                          if not tag.startswith('loc_')}
+        if element_counts:
+            print(f"Element tags found: {element_counts}")
+
     # Sort zones by position (top to bottom, left to right)
     zones.sort(key=lambda z: (z['y1'], z['x1']))
 
@@ -146,26 +90,36 @@ def parse_doctags(doctags_path):
 
     return zones
 
-def create_visualization(image, zones, page_num, output_path):
-    """Create a visualization image with rectangles around zones."""
-    debug_img = image.copy()
-    draw = ImageDraw.Draw(debug_img, mode='RGBA')  # Use RGBA mode for transparency
-
-    print(f"Creating visualization with {len(zones)} zones")
-
+@lru_cache(maxsize=1)
+def load_label_font():
+    """Load the label font once; every later visualization reuses it."""
     # Try to use a default font, fallback to PIL default if not available
     try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 14)
+        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 14)
     except:
         try:
             # Try macOS font locations
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 14)
+            return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 14)
         except:
             try:
                 # Try Windows font locations
-                font = ImageFont.truetype("C:\\Windows\\Fonts\\Arial.ttf", 14)
+                return ImageFont.truetype("C:\\Windows\\Fonts\\Arial.ttf", 14)
             except:
-                font = ImageFont.load_default()
+                return ImageFont.load_default()
+
+def create_visualization(image, zones, page_num, output_path, in_place=False):
+    """
+    Create a visualization image with rectangles around zones.
+
+    With in_place=True the zones are drawn directly onto `image` instead of a
+    copy, avoiding a second full-page buffer when the caller no longer needs it.
+    """
+    debug_img = image if in_place else image.copy()
+    draw = ImageDraw.Draw(debug_img, mode='RGBA')  # Use RGBA mode for transparency
+
+    print(f"Creating visualization with {len(zones)} zones")
+
+    font = load_label_font()
 
     # Draw rectangles for each zone
     zone_count = 0
@@ -265,23 +219,26 @@ def create_visualization(image, zones, page_num, output_path):
     )
 
     # Save the image
-    debug_img.save(output_path, format="PNG")
+    debug_img.save(output_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
     print(f"Visualization saved to: {output_path}")
     print(f"Output image size: {debug_img.size}")
 
     return debug_img
 
-def process_page(pdf_path, page_num, doctags_path, output_path, dpi, adjust):
-    """Process a single page of the PDF with visualization."""
-    results_dir = ensure_results_folder()
+def process_page(pdf_path, page_num, doctags_path, output_path, dpi, adjust, image=None):
+    """
+    Process a single page of the PDF with visualization.
 
+    Pass image to reuse an already rendered page; zones are drawn onto it.
+    """
     if output_path is None:
-        output_path = results_dir / f"visualization_page_{page_num}.png"
+        output_path = ensure_results_folder() / f"visualization_page_{page_num}.png"
     else:
         output_path = Path(output_path)
 
     # Load the page image
-    image = load_pdf_page(pdf_path, page_num, dpi)
+    if image is None:
+        image = load_pdf_page(pdf_path, page_num, dpi)
     print(f"Page {page_num} loaded: {image.size}")
 
     try:
@@ -331,8 +288,8 @@ def process_page(pdf_path, page_num, doctags_path, output_path, dpi, adjust):
         print(f"Warning: {e} for page {page_num}, creating blank visualization")
         zones = []
 
-    # Create visualization (even if no zones)
-    create_visualization(image, zones, page_num, output_path)
+    # Create visualization (even if no zones); the page image is not reused
+    create_visualization(image, zones, page_num, output_path, in_place=True)
 
     return True
 
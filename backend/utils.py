@@ -4,13 +4,23 @@ Common utilities for DocTags processing
 """
 
 import os
+import re
+import signal
 import subprocess
+import tempfile
 import logging
 from pathlib import Path
 from typing import Optional, Tuple, Dict, List
 import pdf2image
+from PIL import Image
 from pdf2image.pdf2image import pdfinfo_from_path
 
+# PyMuPDF renders in-process; pdf2image (poppler subprocess) is the fallback
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
 logger = logging.getLogger(__name__)
 
 # Configuration constants
@@ -18,6 +28,15 @@ DEFAULT_DPI = 200
 DEFAULT_GRID_SIZE = 500
 MAX_WIDTH = 1200
 RESULTS_DIR_NAME = "results"
+COMMAND_OUTPUT_TAIL = 1 << 20  # Keep at most the last 1 MiB of each command output stream
+
+# DocTags patterns
+LOC_PATTERN = r'<loc_(\d+)><loc_(\d+)><loc_(\d+)><loc_(\d+)>'
+LOC_TAG_RE = re.compile(r'<loc_\d+>')
+
+# Tokenizer for a single linear pass over DocTags: a run of four location
+# tags, or an opening/closing element tag. No lazy wildcards, so no backtracking.
+DOCTAG_TOKEN_RE = re.compile(LOC_PATTERN + r'|<(/?)(\w+)>')
 
 def get_project_root() -> Path:
     """Get the project root directory."""
@@ -37,9 +56,11 @@ def ensure_results_folder(custom_path: Optional[str] = None) -> Path:
     else:
         results_dir = get_project_root() / RESULTS_DIR_NAME
 
-    if not results_dir.exists():
+    try:
         results_dir.mkdir(parents=True)
         logger.info(f"Created results directory: {results_dir}")
+    except FileExistsError:
+        pass
 
     return results_dir
 
@@ -49,34 +70,21 @@ def count_pdf_pages(pdf_path: str) -> int:
         logger.error(f"PDF file not found: {pdf_path}")
         return 0
 
+    if fitz is not None:
+        try:
+            with fitz.open(pdf_path) as doc:
+                return doc.page_count
+        except Exception as e:
+            logger.warning(f"PyMuPDF page count failed: {e}, trying pdfinfo")
+
+    # pdfinfo reads the page count from the trailer without rasterizing anything;
+    # if poppler cannot parse the file, rendering pages with it fails as well
     try:
         info = pdfinfo_from_path(pdf_path)
         return info["Pages"]
     except Exception as e:
-        logger.warning(f"pdfinfo failed: {e}, trying fallback method")
-        try:
-            # Fallback: convert first page to check
-            images = pdf2image.convert_from_path(pdf_path, dpi=72, first_page=1, last_page=1)
-            if not images:
-                return 0
-
-            # Binary search for last page
-            low, high = 1, 1000
-            while low < high:
-                mid = (low + high + 1) // 2
-                try:
-                    images = pdf2image.convert_from_path(pdf_path, dpi=72, first_page=mid, last_page=mid)
-                    if images:
-                        low = mid
-                    else:
-                        high = mid - 1
-                except:
-                    high = mid - 1
-
-            return low
-        except Exception as e2:
-            logger.error(f"Error counting PDF pages: {e2}")
-            return 0
+        logger.error(f"Error counting PDF pages: {e}")
+        return 0
 
 def load_pdf_page(pdf_path: str, page_num: int = 1, dpi: int = DEFAULT_DPI) -> Optional[object]:
     """Load a specific page from PDF as an image."""
@@ -84,6 +92,13 @@ def load_pdf_page(pdf_path: str, page_num: int = 1, dpi: int = DEFAULT_DPI) -> O
         raise FileNotFoundError(f"PDF file not found: {pdf_path}")
 
     logger.info(f"Converting PDF page {page_num} to image (DPI: {dpi})...")
+    if fitz is not None:
+        try:
+            with fitz.open(pdf_path) as doc:
+                return render_pdf_page(doc, page_num, dpi)
+        except Exception as e:
+            raise Exception(f"Error converting PDF to image: {e}")
+
     try:
         pdf_images = pdf2image.convert_from_path(
             pdf_path,
@@ -97,6 +112,79 @@ def load_pdf_page(pdf_path: str, page_num: int = 1, dpi: int = DEFAULT_DPI) -> O
     except Exception as e:
         raise Exception(f"Error converting PDF to image: {e}")
 
+def render_pdf_page(doc, page_num: int = 1, dpi: int = DEFAULT_DPI,
+                    max_size: Optional[int] = None):
+    """
+    Render a page of an open PyMuPDF document as an RGB PIL image.
+
+    If max_size is given, dpi is lowered so the longest side of the rendered
+    page does not exceed max_size pixels; dpi stays the upper bound.
+    """
+    if not 1 <= page_num <= doc.page_count:
+        raise Exception(f"Could not extract page {page_num} from PDF")
+
+    page = doc.load_page(page_num - 1)
+    if max_size:
+        longest_side_pt = max(page.rect.width, page.rect.height)
+        dpi = min(dpi, max_size * 72 / longest_side_pt)
+    zoom = dpi / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+def parse_doctag_zones(doctags_text: str) -> List[Dict]:
+    """
+    Extract every located element from DocTags text in a single pass.
+
+    Args:
+        doctags_text: Raw DocTags markup
+
+    Returns:
+        List of zones with type, x1, y1, x2, y2 and content (location tags removed),
+        in document order
+    """
+    # Walk the tags once, keeping a stack of open elements. An element becomes
+    # a zone when it holds a run of location tags and is properly closed.
+    zones = []
+    stack = []
+    for match in DOCTAG_TOKEN_RE.finditer(doctags_text):
+        is_close, tag_name = match.group(5), match.group(6)
+
+        if tag_name is None:
+            # Location run: attach to the innermost open element without one
+            if stack and stack[-1]['locs'] is None:
+                stack[-1]['locs'] = tuple(map(int, match.groups()[:4]))
+            continue
+
+        if tag_name.startswith('loc_'):
+            continue
+
+        if not is_close:
+            stack.append({'type': tag_name, 'start': match.end(), 'locs': None})
+            continue
+
+        # Closing tag: unwind to the matching opening tag, dropping unclosed ones
+        while stack and stack[-1]['type'] != tag_name:
+            stack.pop()
+        if not stack:
+            continue
+
+        element = stack.pop()
+        if element['locs'] is None:
+            continue
+
+        x1, y1, x2, y2 = element['locs']
+        content = doctags_text[element['start']:match.start()]
+        content = LOC_TAG_RE.sub('', content).strip()
+
+        zones.append({
+            'type': tag_name,
+            'x1': x1, 'y1': y1,
+            'x2': x2, 'y2': y2,
+            'content': content
+        })
+
+    return zones
+
 def normalize_coordinates(elements: List[Dict], image_width: int, image_height: int,
                           grid_size: int = DEFAULT_GRID_SIZE) -> List[Dict]:
     """
@@ -169,30 +257,60 @@ def calculate_scale_factor(max_coord: float, image_size: float) -> float:
     else:
         return max(image_size / max_coord, 0.5)
 
-# In backend/utils.py, make sure this function exists:
-def run_command_with_timeout(command: str, timeout: int = 300, input_text: str = "n\n") -> Tuple[bool, str, str]:
-    """
-    Run a command with timeout and return success, stdout, stderr.
-    """
+def read_output_tail(output_file, limit: int = COMMAND_OUTPUT_TAIL) -> str:
+    """Decode at most the last `limit` bytes written to a captured output file."""
+    size = output_file.seek(0, os.SEEK_END)
+    output_file.seek(max(0, size - limit))
+    return output_file.read().decode('utf-8', errors='replace')
+
+def kill_process_group(process: subprocess.Popen, grace: float = 0.5) -> None:
+    """Terminate a process started with start_new_session=True and all its children."""
+    # Output goes to files, so there are no pipes to drain: wait() just reaps
     try:
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            universal_newlines=True
-        )
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=grace)
+        return
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
 
-        stdout, stderr = process.communicate(input=input_text, timeout=timeout)
-        success = process.returncode == 0
+    process.wait()
 
-        return success, stdout, stderr
+def run_command_with_timeout(command: List[str], timeout: int = 300,
+                             input_text: str = "n\n") -> Tuple[bool, str, str]:
+    """
+    Run a command (an argv list, no shell) with timeout and return success, stdout, stderr.
+
+    Output goes straight to temporary files, so the child writes without
+    Python copying it through pipes while it runs; only the tail of each
+    stream is read back, however verbose the command is.
+    """
+    try:
+        with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+            # Own session so a timeout can kill the command and everything it started
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=stdout_file,
+                stderr=stderr_file,
+                start_new_session=True
+            )
+
+            try:
+                process.communicate(input=input_text.encode(), timeout=timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_group(process)
+                return False, "", "Command timed out"
+
+            stdout = read_output_tail(stdout_file)
+            stderr = read_output_tail(stderr_file)
+
+        return process.returncode == 0, stdout, stderr
 
-    except subprocess.TimeoutExpired:
-        process.kill()
-        return False, "", "Command timed out"
     except Exception as e:
         return False, "", str(e)
 
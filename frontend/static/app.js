@@ -140,6 +140,34 @@ function stopPolling() {
     }
 }
 
+// Stream a task's status from the server; fall back to polling without EventSource
+function watchTask(taskId) {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource(`/task-events/${taskId}`);
+
+    source.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        if (data.done) {
+            source.close();
+        }
+        if (appState.activeTasks[taskId]) {
+            updateTaskStatus(taskId, data);
+        }
+    };
+
+    source.onerror = function() {
+        // Stream lost before the task finished: poll for it instead
+        source.close();
+        if (appState.activeTasks[taskId]) {
+            startPolling();
+        }
+    };
+}
+
 async function pollTasks() {
     for (const taskId in appState.activeTasks) {
         try {
@@ -259,7 +287,7 @@ async function runScript(script) {
                 type: script,
                 pageNum: pageNum
             };
-            startPolling();
+            watchTask(data.task_id);
 
             ui.setText('output', data.message || 'Task started, please wait...');
             ui.show('output');
@@ -468,12 +496,4 @@ window.addEventListener('DOMContentLoaded', async function() {
     // Initial checks
     checkEnvironment();
     loadExtractedImages();
-
-    // Check for existing visualization
-    try {
-        const response = await fetch('/results/visualization_page_1.png');
-        if (response.ok) {
-            appState.generatedOutputs.visualizer = '/results/visualization_page_1.png';
-        }
-    } catch {}
 });
\ No newline at end of file
@@ -3,6 +3,7 @@ const batchState = {
     isProcessing: false,
     isPaused: false,
     currentBatchId: null,
+    pdfFile: null,
     totalPages: 0,
     processedPages: 0,
     startTime: null,
@@ -13,7 +14,8 @@ const batchState = {
         totalImages: 0,
         failedPages: []
     },
-    autoScroll: true
+    autoScroll: true,
+    eventSource: null
 };
 
 // Timer for elapsed time
@@ -146,6 +148,7 @@ function startBatchProcessing() {
         .then(data => {
             if (data.success) {
                 batchState.currentBatchId = data.batch_id;
+                batchState.pdfFile = pdfFile;
                 addConsoleMessage(`Batch processing started with ID: ${data.batch_id}`, 'success');
 
                 // Start polling for updates
@@ -161,12 +164,61 @@ function startBatchProcessing() {
         });
 }
 
-// Poll for batch status updates
+// Follow batch status updates, streamed by the server when EventSource is available
 function pollBatchStatus() {
     if (!batchState.isProcessing || !batchState.currentBatchId) {
         return;
     }
 
+    if (!window.EventSource) {
+        pollBatchStatusOnce();
+        return;
+    }
+
+    // Already streaming (e.g. resumed after a pause)
+    if (batchState.eventSource) {
+        return;
+    }
+
+    const source = new EventSource(`/batch-events/${batchState.currentBatchId}`);
+    batchState.eventSource = source;
+
+    source.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        updateBatchProgress(data);
+
+        if (data.completed) {
+            closeBatchEvents();
+            finishBatchProcessing(true);
+        }
+    };
+
+    source.onerror = function() {
+        // EventSource reconnects by itself; only give up once processing has stopped
+        if (!batchState.isProcessing) {
+            closeBatchEvents();
+        } else if (source.readyState === EventSource.CLOSED) {
+            // Refused for good (e.g. 503 when the server has no stream slots left): poll
+            closeBatchEvents();
+            pollBatchStatusOnce();
+        }
+    };
+}
+
+// Stop listening for streamed batch status
+function closeBatchEvents() {
+    if (batchState.eventSource) {
+        batchState.eventSource.close();
+        batchState.eventSource = null;
+    }
+}
+
+// Poll for batch status updates (fallback without EventSource)
+function pollBatchStatusOnce() {
+    if (!batchState.isProcessing || !batchState.currentBatchId) {
+        return;
+    }
+
     fetch(`/batch-status/${batchState.currentBatchId}`)
         .then(response => response.json())
         .then(data => {
@@ -176,13 +228,13 @@ function pollBatchStatus() {
                 finishBatchProcessing(true);
             } else if (!batchState.isPaused) {
                 // Continue polling
-                setTimeout(pollBatchStatus, 1000);
+                setTimeout(pollBatchStatusOnce, 1000);
             }
         })
         .catch(error => {
             console.error('Error polling batch status:', error);
             if (batchState.isProcessing) {
-                setTimeout(pollBatchStatus, 2000); // Retry with longer delay
+                setTimeout(pollBatchStatusOnce, 2000); // Retry with longer delay
             }
         });
 }
@@ -277,7 +329,7 @@ function updatePageStatus(pageNum, status) {
     if (!item) return;
 
     // Remove all status classes
-    item.classList.remove('pending', 'processing', 'completed', 'failed');
+    item.classList.remove('pending', 'processing', 'completed', 'failed', 'cancelled');
 
     // Add new status class
     item.classList.add(status.toLowerCase());
@@ -287,7 +339,8 @@ function updatePageStatus(pageNum, status) {
         'pending': '⏳',
         'processing': '🔄',
         'completed': '✅',
-        'failed': '❌'
+        'failed': '❌',
+        'cancelled': '⏹️'
     };
 
     const iconElement = item.querySelector('.page-status-icon');
@@ -319,8 +372,10 @@ function viewPageResults(pageNum) {
 
     // Handle loading errors
     vizImage.onerror = function() {
-        // Try the regular results directory as fallback
-        this.src = `/results/visualization_page_${pageNum}.png?t=${Date.now()}`;
+        // Try the regular results directory as fallback; web visualizations
+        // are named after the PDF's stem, like its DocTags files
+        const pdfStem = (batchState.pdfFile || '').replace(/\.[^.]*$/, '');
+        this.src = `/results/${encodeURIComponent(pdfStem)}_visualization_page_${pageNum}.png?t=${Date.now()}`;
 
         this.onerror = function() {
             this.alt = 'Visualization not found';
@@ -466,6 +521,7 @@ function cancelBatchProcessing() {
 // Finish batch processing
 function finishBatchProcessing(success) {
     batchState.isProcessing = false;
+    closeBatchEvents();
     stopElapsedTimer();
 
     // Update UI